@@ -1,3 +1,5 @@
 from .utils import *
 from .serializers import FlexFieldsModelSerializer
-from .views import FlexFieldsModelViewSet
\ No newline at end of file
+from .views import FlexFieldsModelViewSet
+
+default_app_config = 'rest_flex_fields.apps.RestFlexFieldsConfig'
@@ -0,0 +1,42 @@
+from django.apps import AppConfig, apps
+from django.core import checks
+
+
+class RestFlexFieldsConfig(AppConfig):
+    """
+    Adding 'rest_flex_fields' to INSTALLED_APPS resolves every string
+    reference in expandable_fields at startup instead of on first use,
+    reports cycles in the expansion graph through the system checks, and
+    registers the serializers that cache their representations, so that
+    model changes invalidate them before they are first used in this process.
+    """
+    name = 'rest_flex_fields'
+    verbose_name = 'REST Flex Fields'
+    expansion_cycles = ()
+
+    def ready(self):
+        from .serializers import FlexFieldsSerializerMixin, _get_subclasses, register_cached_serializer, warm_serializer_registry
+        self.expansion_cycles = warm_serializer_registry()
+        checks.register(check_expansion_cycles)
+
+        for serializer_class in _get_subclasses(FlexFieldsSerializerMixin):
+            if serializer_class.cache_representations and getattr(getattr(serializer_class, 'Meta', None), 'model', None):
+                register_cached_serializer(serializer_class)
+
+
+def check_expansion_cycles(app_configs=None, **kwargs):
+    """
+    Warns about each cycle of serializers that can expand one another, found
+    when the app was loaded.
+    """
+    return [
+        checks.Warning(
+            'Serializers expand into each other in a cycle: {}.'.format(
+                ' -> '.join(serializer_class.__name__ for serializer_class in cycle + [cycle[0]])
+            ),
+            hint='Set max_expand_depth on the root serializers, or silence rest_flex_fields.W001 if the cycle is intended.',
+            obj=cycle[0],
+            id='rest_flex_fields.W001',
+        )
+        for cycle in apps.get_app_config('rest_flex_fields').expansion_cycles
+    ]
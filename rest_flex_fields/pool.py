@@ -0,0 +1,129 @@
+"""
+This module keeps fully built serializer trees for reuse by later requests
+with the same expand, fields, omit and identifier parameters.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+
+PoolInfo = namedtuple('PoolInfo', ['hits', 'misses', 'leaks', 'keys', 'idle'])
+
+# per-request state DRF keeps on a serializer once it has been used
+REQUEST_STATE = ('initial_data', '_data', '_validated_data', '_errors')
+
+# per-request state kept on fields, such as the request HyperlinkedRelatedField
+# memoizes its URL templates for
+FIELD_REQUEST_STATE = ('_url_templates', '_url_templates_request')
+
+
+class SerializerPool:
+    """
+    A thread-safe pool of idle serializer trees per key, holding at most
+    `maxkeys` keys and evicting the least recently used one. A tree is
+    reset when it is released and checked again when it is acquired; a tree
+    that still carries state from another request, on a serializer or on
+    any of its fields, is discarded and counted as a leak.
+    """
+    def __init__(self, maxkeys=256):
+        self.maxkeys = maxkeys
+        self.hits = 0
+        self.misses = 0
+        self.leaks = 0
+        self._idle = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """
+        Returns an idle tree for `key`, or None.
+        """
+        with self._lock:
+            trees = self._idle.get(key)
+
+            while trees:
+                tree = trees.pop()
+                if is_clean(tree):
+                    self._idle.move_to_end(key)
+                    self.hits += 1
+                    return tree
+                self.leaks += 1
+
+            self.misses += 1
+            return None
+
+    def release(self, key, tree, maxsize):
+        """
+        Resets `tree` and keeps it for `key` unless `maxsize` trees are
+        already idle there.
+        """
+        reset(tree)
+
+        with self._lock:
+            trees = self._idle.setdefault(key, [])
+            self._idle.move_to_end(key)
+
+            if len(trees) < maxsize and not any(idle is tree for idle in trees):
+                trees.append(tree)
+
+            while len(self._idle) > self.maxkeys:
+                self._idle.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
+            self.hits = 0
+            self.misses = 0
+            self.leaks = 0
+
+    def info(self):
+        with self._lock:
+            return PoolInfo(self.hits, self.misses, self.leaks, len(self._idle), sum(map(len, self._idle.values())))
+
+
+def _request_holders(tree):
+    child = getattr(tree, 'child', None)
+    return (tree, child) if child is not None else (tree,)
+
+
+def _iter_fields(tree):
+    # only what has been built: reading .fields would build it. DRF < 3.10
+    # keeps built fields in _fields rather than a cached fields attribute
+    pending = [tree]
+
+    while pending:
+        field = pending.pop()
+        yield field
+        pending.extend(field.__dict__[name] for name in ('child', 'child_relation') if field.__dict__.get(name) is not None)
+        pending.extend((field.__dict__.get('fields') or field.__dict__.get('_fields') or {}).values())
+
+
+def reset(tree):
+    for serializer in _request_holders(tree):
+        serializer.instance = None
+        serializer._context = {}
+        for name in REQUEST_STATE:
+            serializer.__dict__.pop(name, None)
+
+    for field in _iter_fields(tree):
+        for name in FIELD_REQUEST_STATE:
+            field.__dict__.pop(name, None)
+
+    memo = tree.__dict__.get('_representation_memo_store')
+    if memo is not None:
+        memo.clear()
+
+
+def is_clean(tree):
+    return not tree.__dict__.get('_representation_memo_store') and all(
+        serializer.instance is None and not serializer._context and
+        not any(name in serializer.__dict__ for name in REQUEST_STATE)
+        for serializer in _request_holders(tree)
+    ) and not any(name in field.__dict__ for field in _iter_fields(tree) for name in FIELD_REQUEST_STATE)
+
+
+def bind(tree, instance, context):
+    for serializer in _request_holders(tree):
+        serializer._context = context
+    tree.instance = instance
+
+
+serializer_pool = SerializerPool()
@@ -0,0 +1,129 @@
+"""
+This module collects a timing breakdown of flex-field request handling:
+parsing the query params, building the serializer tree, planning the
+queryset, running SQL and producing the representation.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from django.dispatch import Signal
+
+try:
+    from contextvars import ContextVar
+except ImportError:  # Python < 3.7
+    ContextVar = None
+
+
+# Sent with `profile` and `request` once a profiled request has been handled.
+request_profiled = Signal()
+
+
+class _LocalVar(threading.local):
+    """
+    The part of ContextVar used here, kept per thread where contextvars is
+    not available.
+    """
+    value = None
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        token, self.value = self.value, value
+        return token
+
+    def reset(self, token):
+        self.value = token
+
+
+_current_profile = ContextVar('rest_flex_fields_profile', default=None) if ContextVar is not None else _LocalVar()
+
+PHASES = ('parse', 'build', 'plan', 'sql', 'represent')
+
+
+def get_current_profile():
+    """
+    Returns the RequestProfile collecting for the current request, or None.
+    """
+    return _current_profile.get()
+
+
+class RequestProfile:
+    """
+    Durations per phase, in seconds, and counters for one request. Phases
+    can nest: 'sql' time spent evaluating a queryset during 'represent' is
+    counted in both.
+    """
+    def __init__(self):
+        self.durations = dict.fromkeys(PHASES, 0.0)
+        self.counters = {'serializers': 0, 'fields_dropped': 0, 'fields_replaced': 0, 'queries': 0}
+        self.select_related = []
+        self.prefetch_related = []
+        self._depth = dict.fromkeys(PHASES, 0)
+
+    @contextmanager
+    def activate(self):
+        token = _current_profile.set(self)
+        try:
+            yield self
+        finally:
+            _current_profile.reset(token)
+
+    @contextmanager
+    def phase(self, name):
+        # re-entrant: only the outermost entry of a phase is timed
+        self._depth[name] += 1
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._depth[name] -= 1
+            if not self._depth[name]:
+                self.durations[name] += time.perf_counter() - started
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_query_plan(self, plan, prefix=''):
+        if not prefix:
+            self.select_related, self.prefetch_related = [], []
+
+        self.select_related.extend(prefix + lookup for lookup in plan.select_related)
+        self.prefetch_related.extend(prefix + lookup for lookup in plan.prefetch_related)
+
+        for lookup, nested in plan.prefetches.items():
+            self.prefetch_related.append(prefix + lookup)
+            self.record_query_plan(nested, prefix + lookup + '__')
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        self.count('queries')
+        with self.phase('sql'):
+            return execute(sql, params, many, context)
+
+    def server_timing(self):
+        """
+        Formats the durations as a Server-Timing header value, in milliseconds.
+        """
+        return ', '.join('flex-{};dur={:.2f}'.format(name, duration * 1000) for name, duration in self.durations.items())
+
+    def as_dict(self):
+        return {
+            'durations_ms': {name: round(duration * 1000, 3) for name, duration in self.durations.items()},
+            'counters': dict(self.counters),
+            'select_related': list(self.select_related),
+            'prefetch_related': list(self.prefetch_related),
+        }
+
+
+@contextmanager
+def profile_phase(name):
+    """
+    Times `name` on the current profile; does nothing if none is collecting.
+    """
+    profile = _current_profile.get()
+
+    if profile is None:
+        yield
+    else:
+        with profile.phase(name):
+            yield
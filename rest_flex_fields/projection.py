@@ -0,0 +1,118 @@
+"""
+This module turns an expanded, sparse serializer into a values() projection,
+so read-only requests can be answered without instantiating models.
+"""
+from collections import OrderedDict
+from django.db.models import ForeignKey
+from django.db.models.query_utils import DeferredAttribute
+from rest_framework import serializers
+from rest_framework.relations import PKOnlyObject
+from .query_plan import get_model_field
+from .serializers import FlexFieldsSerializerMixin, PrimaryKeyRelatedField
+
+try:
+    from django.db.models.fields.related_descriptors import ForeignKeyDeferredAttribute
+except ImportError:  # Django < 3.0
+    ForeignKeyDeferredAttribute = DeferredAttribute
+
+
+PROJECTABLE_SERIALIZER_METHODS = (FlexFieldsSerializerMixin.to_representation, serializers.Serializer.to_representation)
+PROJECTABLE_RELATED_METHODS = (PrimaryKeyRelatedField.to_representation, serializers.PrimaryKeyRelatedField.to_representation)
+
+
+class ValuesProjection:
+    """
+    The values() lookups for a serializer and the steps that assemble each
+    row dict back into the nested representation the serializer would have
+    produced. Plain columns and primary key related fields are projected,
+    and nested serializers are followed through foreign keys.
+    """
+    def __init__(self, steps, lookups):
+        self.steps = steps
+        self.lookups = lookups
+
+    @classmethod
+    def build(cls, serializer, model):
+        """
+        Returns the projection for `serializer`, or None if any field needs
+        something values() can't provide, such as method fields, properties,
+        many-valued relations or a custom to_representation().
+        """
+        lookups = []
+        steps = cls._build_steps(serializer, model, '', lookups)
+        return None if steps is None else cls(steps, lookups)
+
+    @classmethod
+    def _build_steps(cls, serializer, model, prefix, lookups):
+        if type(serializer).to_representation not in PROJECTABLE_SERIALIZER_METHODS:
+            return None
+
+        steps = []
+
+        for field in serializer.fields.values():
+            if field.write_only:
+                continue
+
+            if field.source == '*' or len(field.source_attrs) != 1:
+                return None
+
+            model_field = get_model_field(model, field.source)
+
+            if isinstance(field, serializers.BaseSerializer):
+                if isinstance(field, serializers.ListSerializer) or not isinstance(model_field, ForeignKey):
+                    return None
+                nested_prefix = prefix + field.source + '__'
+                pk_lookup = nested_prefix + model_field.related_model._meta.pk.name
+                lookups.append(pk_lookup)
+                nested_steps = cls._build_steps(field, model_field.related_model, nested_prefix, lookups)
+                if nested_steps is None:
+                    return None
+                steps.append((field.field_name, pk_lookup, field, nested_steps))
+
+            elif isinstance(field, serializers.PrimaryKeyRelatedField):
+                if not isinstance(model_field, ForeignKey) or field.pk_field is not None:
+                    return None
+                if type(field).get_attribute is not serializers.RelatedField.get_attribute:
+                    return None
+                if type(field).to_representation not in PROJECTABLE_RELATED_METHODS:
+                    return None
+                lookups.append(prefix + field.source)
+                steps.append((field.field_name, prefix + field.source, field, PKOnlyObject))
+
+            elif cls._is_plain_column(field, model, model_field):
+                lookups.append(prefix + field.source)
+                steps.append((field.field_name, prefix + field.source, field, None))
+
+            else:
+                return None
+
+        return steps
+
+    @staticmethod
+    def _is_plain_column(field, model, model_field):
+        if model_field is None or not model_field.concrete or model_field.is_relation:
+            return False
+        if type(field).get_attribute is not serializers.Field.get_attribute:
+            return False
+        # fields with their own descriptor (e.g. files) differ from their column value
+        return type(getattr(model, model_field.attname, None)) in (DeferredAttribute, ForeignKeyDeferredAttribute)
+
+    def to_representation(self, row):
+        return self._assemble(row, self.steps)
+
+    def _assemble(self, row, steps):
+        ret = OrderedDict()
+
+        for field_name, lookup, field, nested in steps:
+            value = row[lookup]
+
+            if value is None:
+                ret[field_name] = None
+            elif nested is PKOnlyObject:
+                ret[field_name] = field.to_representation(PKOnlyObject(pk=value))
+            elif nested is not None:
+                ret[field_name] = self._assemble(row, nested)
+            else:
+                ret[field_name] = field.to_representation(value)
+
+        return ret
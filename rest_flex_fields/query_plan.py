@@ -0,0 +1,267 @@
+"""
+This module plans how to fetch the data needed by an expanded, sparse
+serializer tree: which relations to join, which to prefetch and which columns
+to load.
+"""
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import ForeignKey, ManyToManyField, ManyToManyRel, ManyToOneRel, OneToOneRel, Prefetch
+from rest_framework import serializers
+
+
+class QueryPlan:
+    """
+    The select_related lookups, prefetches and only() columns for one model.
+    Every prefetched relation has its own nested QueryPlan, so relations
+    expanded below a prefetch are joined inside the prefetch queryset.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.select_related = []
+        self.prefetch_related = []
+        self.prefetches = {}
+        self.only = None
+
+    @classmethod
+    def build(cls, serializer, model, identifier=None, prune_columns=True, extra_columns=(), skip_sources=()):
+        plan = cls(model)
+        columns = plan._add_joined_level(serializer, model, identifier, prune_columns, '', skip_sources)
+
+        if prune_columns and columns is not None:
+            plan.only = _unique(columns + list(extra_columns))
+
+        return plan
+
+    def _add_joined_level(self, serializer, model, identifier, prune_columns, prefix, skip_sources=()):
+        """
+        Plans one model reached through joins and returns the columns it needs,
+        or None if a field reads something other than plain model fields.
+        """
+        columns = [prefix + model._meta.pk.name]
+        nested_columns = []
+        prunable = True
+
+        if identifier in ('name', 'reference'):
+            for name in serializer.related_fields:
+                model_field = get_model_field(model, name)
+                if isinstance(model_field, ForeignKey) and name not in skip_sources:
+                    self._add_select_related(prefix + name)
+                    columns.append(prefix + name)
+            for name in serializer.many_related_fields:
+                self._add_prefetch_related(prefix + name)
+
+        for field in serializer.fields.values():
+            if field.write_only or field.source in skip_sources:
+                continue
+
+            model_field = get_expanded_model_field(field, model)
+
+            if model_field is not None and isinstance(field, serializers.ListSerializer):
+                if is_many_relation(model_field):
+                    self._add_prefetch(field.child, model_field, identifier, prune_columns, prefix + field.source)
+
+                    if isinstance(model_field, ManyToOneRel):
+                        # Django points each prefetched row's foreign key back at
+                        # this instance, so anything expanded through it must be
+                        # fetched at this level.
+                        for back_field in field.child.fields.values():
+                            if back_field.source != model_field.field.name:
+                                continue
+                            if isinstance(back_field, serializers.Serializer):
+                                back_columns = self._add_joined_level(back_field, model, identifier, prune_columns, prefix)
+                                prunable = prunable and back_columns is not None
+                                nested_columns.extend(back_columns or [])
+                            elif isinstance(back_field, serializers.SlugRelatedField):
+                                prunable = False
+                continue
+
+            if model_field is not None and isinstance(model_field, (ForeignKey, OneToOneRel)):
+                lookup = prefix + field.source
+                self._add_select_related(lookup)
+                nested = self._add_joined_level(field, model_field.related_model, identifier, prune_columns, lookup + '__')
+
+                if isinstance(model_field, ForeignKey):
+                    columns.append(lookup)
+                    nested_columns.extend(nested or [])
+                continue
+
+            if prunable:
+                field_columns = get_field_columns(field, model)
+                if field_columns is None:
+                    prunable = False
+                else:
+                    columns.extend(prefix + column for column in field_columns)
+
+        return columns + nested_columns if prunable else None
+
+    def _add_prefetch(self, serializer, relation, identifier, prune_columns, lookup):
+        extra_columns, skip_sources = [], []
+
+        if isinstance(relation, ManyToOneRel):
+            # a reverse foreign key needs its own column to attach the results
+            extra_columns = skip_sources = [relation.field.name]
+
+        self.prefetches[lookup] = QueryPlan.build(
+            serializer, relation.related_model, identifier, prune_columns, extra_columns, skip_sources
+        )
+
+    def _add_select_related(self, lookup):
+        if lookup not in self.select_related:
+            self.select_related.append(lookup)
+
+    def _add_prefetch_related(self, lookup):
+        if lookup not in self.prefetch_related:
+            self.prefetch_related.append(lookup)
+
+    def apply(self, queryset):
+        """
+        Applies the plan to `queryset`. Columns are not restricted if the
+        queryset already uses only()/defer() or select_related() without
+        arguments, and lookups already prefetched by the queryset, or
+        traversed by its nested lookups, are kept. Relations the queryset already joins keep their foreign key columns.
+        """
+        joined = queryset.query.select_related
+        joined_columns = get_joined_columns(self.model, joined) if isinstance(joined, dict) else []
+
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+
+        # a lookup such as 'pets__owner' also prefetches 'pets'
+        seen = set()
+        for lookup in queryset._prefetch_related_lookups:
+            parts = getattr(lookup, 'prefetch_to', lookup).split('__')
+            seen.update('__'.join(parts[:i]) for i in range(1, len(parts) + 1))
+        queryset = queryset.prefetch_related(*[lookup for lookup in self.prefetch_related if lookup not in seen])
+
+        for lookup, plan in self.prefetches.items():
+            if lookup not in seen:
+                queryset = queryset.prefetch_related(Prefetch(lookup, queryset=plan.apply(plan.model._default_manager.all())))
+
+        deferred_fields, defer = queryset.query.deferred_loading
+
+        if self.only is not None and joined_columns is not None and queryset.query.select_related is not True and defer and not deferred_fields:
+            queryset = queryset.only(*_unique(self.only + joined_columns))
+
+        return queryset
+
+    @property
+    def query_count(self):
+        """
+        The number of queries needed to evaluate a queryset with this plan.
+        """
+        return 1 + len(self.prefetch_related) + sum(plan.query_count for plan in self.prefetches.values())
+
+    def relation_paths(self, prefix=''):
+        """
+        Yields (lookup, model) for every relation the plan joins or
+        prefetches, with lookups usable in filter() and aggregate().
+        """
+        for lookup in self.select_related + self.prefetch_related:
+            yield get_query_path(self.model, lookup, prefix)
+
+        for lookup, plan in self.prefetches.items():
+            path, model = get_query_path(self.model, lookup, prefix)
+            yield path, model
+            yield from plan.relation_paths(path + '__')
+
+    def as_dict(self):
+        return {
+            'model': self.model._meta.label,
+            'select_related': list(self.select_related),
+            'prefetch_related': list(self.prefetch_related),
+            'prefetches': {lookup: plan.as_dict() for lookup, plan in self.prefetches.items()},
+            'only': list(self.only) if self.only is not None else None,
+        }
+
+
+def get_model_field(model, name):
+    """
+    Looks up a model field by name, or a reverse relation by accessor name.
+    """
+    try:
+        return model._meta.get_field(name)
+    except FieldDoesNotExist:
+        relations = {rel.get_accessor_name(): rel for rel in model._meta.related_objects}
+        return relations.get(name)
+
+
+def get_joined_columns(model, select_related, prefix=''):
+    """
+    Returns the foreign key columns only() must keep for the relations in a
+    query's select_related dict, or None if one of them isn't a forward
+    foreign key.
+    """
+    columns = []
+
+    for name, nested in select_related.items():
+        model_field = get_model_field(model, name)
+
+        if not isinstance(model_field, ForeignKey):
+            return None
+
+        nested_columns = get_joined_columns(model_field.related_model, nested, prefix + name + '__')
+
+        if nested_columns is None:
+            return None
+
+        columns += [prefix + name] + nested_columns
+
+    return columns
+
+
+def get_query_path(model, lookup, prefix=''):
+    """
+    Translates a select_related/prefetch_related lookup into a query lookup,
+    replacing reverse accessor names with query names, and returns it with
+    the model it ends on.
+    """
+    names = []
+
+    for name in lookup.split('__'):
+        model_field = get_model_field(model, name)
+        names.append(model_field.field.related_query_name() if model_field.auto_created and not model_field.concrete else name)
+        model = model_field.related_model
+
+    return prefix + '__'.join(names), model
+
+
+def get_expanded_model_field(field, model):
+    """
+    Returns the model field or relation behind a nested serializer field, or None.
+    """
+    if not isinstance(field, serializers.BaseSerializer) or field.source == '*' or '.' in field.source:
+        return None
+    return get_model_field(model, field.source)
+
+
+def get_field_columns(field, model):
+    """
+    Returns the columns of `model` read by a non-expanded field, or None if the
+    field reads something other than plain model fields.
+    """
+    if field.source == '*':
+        if not isinstance(field, serializers.HyperlinkedIdentityField):
+            return None
+        source_attrs = [field.lookup_field]
+    else:
+        source_attrs = field.source_attrs
+
+    if source_attrs[0] == 'pk':
+        return []
+
+    model_field = get_model_field(model, source_attrs[0])
+
+    if model_field is None:
+        return None
+
+    return [model_field.name] if model_field.concrete else []
+
+
+def is_many_relation(model_field):
+    return (
+        isinstance(model_field, (ManyToManyField, ManyToManyRel)) or
+        isinstance(model_field, ManyToOneRel) and not isinstance(model_field, OneToOneRel)
+    )
+
+
+def _unique(values):
+    return list(dict.fromkeys(values))
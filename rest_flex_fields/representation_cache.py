@@ -0,0 +1,174 @@
+"""
+This module keeps serialized representations across requests in Django's
+cache framework, and invalidates them when the models they were built from
+are saved or deleted.
+"""
+import hashlib
+import threading
+import time
+from collections import namedtuple
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+
+RepresentationCacheInfo = namedtuple('RepresentationCacheInfo', ['hits', 'misses', 'invalidations', 'hit_ratio'])
+
+
+class RepresentationCache:
+    """
+    Stores representations keyed by serializer plan, model and primary key.
+    Every key also includes two generation counters: one per object, bumped
+    when that object is saved, deleted or gains or loses many-to-many
+    related objects, and one per model, bumped when an object of a model its
+    representations depend on changes, or when clear() on a many-to-many
+    relation doesn't say which objects were related. Bumping a
+    counter orphans the old entries, which then expire from the backend.
+    Missing counters start from the current time rather than zero, so a
+    counter evicted by the backend never revives entries keyed by an
+    earlier value.
+    """
+    key_prefix = 'flex'
+
+    def __init__(self, backend=None, timeout=300):
+        self.backend = backend if backend is not None else LocMemCache('rest_flex_fields', {'OPTIONS': {'MAX_ENTRIES': 100000}})
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._dependents = {}
+        self._lock = threading.Lock()
+
+    def register(self, model, dependencies):
+        """
+        Records that representations of `model` embed data from each of the
+        `dependencies` models.
+        """
+        with self._lock:
+            self._dependents.setdefault(model._meta.label, set())
+            for dependency in dependencies:
+                self._dependents.setdefault(dependency._meta.label, set()).add(model._meta.label)
+
+    def get_or_build(self, plan_key, instance, build):
+        return self.get_or_build_many(plan_key, [instance], build)[0]
+
+    def get_or_build_many(self, plan_key, instances, build):
+        """
+        Returns the representations of `instances`, calling build(instance)
+        for the missing ones, with one backend read for the generations and
+        one for the representations.
+        """
+        keys = self._make_keys(plan_key, instances)
+        found = self.backend.get_many(keys)
+        missing = {}
+        ret = []
+
+        for key, instance in zip(keys, instances):
+            if key not in found:
+                found[key] = missing[key] = build(instance)
+            ret.append(found[key])
+
+        if missing:
+            self.backend.set_many(missing, self.timeout)
+
+        with self._lock:
+            self.hits += len(instances) - len(missing)
+            self.misses += len(missing)
+
+        return ret
+
+    def invalidate(self, instance):
+        """
+        Drops the representations of `instance` and those of every model
+        registered as depending on its model.
+        """
+        self._invalidate(instance._meta.label, [instance.pk])
+
+    def _invalidate(self, label, pks):
+        # without primary keys, every object of the model is dropped
+        if pks is None:
+            self._bump(self._model_generation_key(label))
+        else:
+            for pk in pks:
+                self._bump(self._object_generation_key(label, pk))
+
+        for dependent in self._dependents.get(label, ()):
+            self._bump(self._model_generation_key(dependent))
+
+        with self._lock:
+            self.invalidations += 1
+
+    def info(self):
+        lookups = self.hits + self.misses
+        return RepresentationCacheInfo(self.hits, self.misses, self.invalidations, self.hits / lookups if lookups else 0.0)
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.invalidations = 0
+
+    def _make_keys(self, plan_key, instances):
+        generation_keys = {}
+
+        for instance in instances:
+            label = instance._meta.label
+            generation_keys[self._model_generation_key(label)] = None
+            generation_keys[self._object_generation_key(label, instance.pk)] = None
+
+        generations = self.backend.get_many(generation_keys)
+
+        for key in generation_keys:
+            if key not in generations:
+                self.backend.add(key, self._new_generation(), None)
+                generations[key] = self.backend.get(key)
+
+        return [
+            '{}:rep:{}'.format(self.key_prefix, hashlib.md5(repr((
+                plan_key,
+                instance._meta.label,
+                instance.pk,
+                generations[self._model_generation_key(instance._meta.label)],
+                generations[self._object_generation_key(instance._meta.label, instance.pk)],
+            )).encode()).hexdigest())
+            for instance in instances
+        ]
+
+    def _model_generation_key(self, label):
+        return '{}:gen:{}'.format(self.key_prefix, label)
+
+    def _object_generation_key(self, label, pk):
+        return '{}:gen:{}:{}'.format(self.key_prefix, label, pk)
+
+    def _bump(self, key):
+        try:
+            self.backend.incr(key)
+        except ValueError:
+            if not self.backend.add(key, self._new_generation(), None):
+                self.backend.incr(key)
+
+    @staticmethod
+    def _new_generation():
+        return int(time.time() * 1000000)
+
+    def _handle_change(self, sender, instance, **kwargs):
+        if sender._meta.label in self._dependents:
+            self.invalidate(instance)
+
+    def _handle_m2m_change(self, sender, instance, action, model, pk_set, **kwargs):
+        # add(), remove() and clear() change both sides of the relation
+        if action not in ('post_add', 'post_remove', 'post_clear'):
+            return
+
+        if instance._meta.label in self._dependents:
+            self.invalidate(instance)
+
+        if model._meta.label in self._dependents:
+            self._invalidate(model._meta.label, pk_set)
+
+
+representation_cache = RepresentationCache()
+
+post_save.connect(representation_cache._handle_change, dispatch_uid='rest_flex_fields.representation_cache')
+post_delete.connect(representation_cache._handle_change, dispatch_uid='rest_flex_fields.representation_cache')
+m2m_changed.connect(representation_cache._handle_m2m_change, dispatch_uid='rest_flex_fields.representation_cache')
@@ -1,7 +1,102 @@
 import importlib
 import copy
+import re
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from types import MappingProxyType
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured, ObjectDoesNotExist
+from django.db import connections, models
+from django.urls import NoReverseMatch
+from django.utils.module_loading import autodiscover_modules
 from rest_framework import serializers
-from rest_flex_fields import split_list, split_levels
+from rest_framework.fields import SkipField
+from rest_framework.relations import PKOnlyObject
+from rest_flex_fields import FieldTree, get_flex_params, to_field_tree
+from .cache import LRUCache
+from .profiling import get_current_profile, profile_phase
+from .query_plan import QueryPlan
+from .representation_cache import representation_cache
+
+
+field_plan_cache = LRUCache(maxsize=256)
+related_fields_cache = {}
+expandable_fields_cache = {}
+identifier_templates_cache = {}
+cached_serializer_classes = set()
+field_templates_cache = {}
+
+REGEX_TYPE = type(re.compile(''))
+
+
+def _freeze_option(value):
+    return tuple(value) if isinstance(value, (list, tuple)) else value
+
+
+def _clone_field(field):
+    # rebuilt from its arguments like Field.__deepcopy__, which leaves regexes
+    # and validators uncopied; validators that keep per-use state through
+    # set_context() are copied, so no clone shares it with another
+    args = [arg if isinstance(arg, REGEX_TYPE) else copy.deepcopy(arg) for arg in field._args]
+    kwargs = {
+        key: value if key == 'regex' else _copy_validators(value) if key == 'validators' else copy.deepcopy(value)
+        for key, value in field._kwargs.items()
+    }
+    return field.__class__(*args, **kwargs)
+
+
+def _copy_validators(validators):
+    if validators is None:
+        return None
+    return [copy.copy(validator) if hasattr(validator, 'set_context') else validator for validator in validators]
+
+
+def _copy_representation(value):
+    value = value.copy()
+    items = value.items() if isinstance(value, dict) else enumerate(value)
+
+    for key, item in items:
+        if isinstance(item, (dict, list)):
+            value[key] = _copy_representation(item)
+
+    return value
+
+
+class ExpandableField:
+    """
+    A validated, read-only entry of Meta.expandable_fields. Settings are
+    exposed as a mappingproxy and merged with the per-instance options through
+    a shallow copy, so they are never deep-copied or mutated. The optional
+    'cost' setting is kept apart: it weighs the expansion against the expand
+    budget of the root serializer.
+    """
+    def __init__(self, name, serializer_class, settings):
+        serializer_class = import_serializer_class(serializer_class)
+        assert getattr(serializer_class, 'is_flex_field', False), '{} does not support being an expandable_field; try inheriting from FlexFieldsSerializerMixin'.format(serializer_class)
+        settings = dict(settings)
+
+        if settings.get('source') == name:
+            del settings['source']
+
+        self.name = name
+        self.cost = settings.pop('cost', None)
+        self.serializer_class = serializer_class
+        self.settings = MappingProxyType(settings)
+
+
+class FieldPlan:
+    """
+    The precomputed keep/drop/expand decisions for one serializer class and
+    one combination of expand, fields, omit and identifier. Plans are shared
+    between serializer instances, so they must never be mutated.
+    """
+    def __init__(self, dropped_fields, expanded_fields, nested_expand, nested_fields, nested_omit):
+        self.dropped_fields = dropped_fields
+        self.expanded_fields = expanded_fields
+        self.nested_expand = nested_expand
+        self.nested_fields = nested_fields
+        self.nested_omit = nested_omit
 
 
 class SafeSlugRelatedField(serializers.SlugRelatedField):
@@ -14,13 +109,45 @@ class SafeSlugRelatedField(serializers.SlugRelatedField):
 
 class HyperlinkedRelatedField(serializers.HyperlinkedRelatedField):
     """
-    Also supports creating url directly from pk
+    Also supports creating url directly from pk. For integer lookup values,
+    each (view_name, format) pair is reversed once per request into a
+    prefix and suffix around the lookup value.
     """
+    url_template_sentinel = 987654321987654321
+
     def get_url(self, obj, view_name, request, format):
         lookup_value = obj if isinstance(obj, int) else getattr(obj, self.lookup_field)
+
+        if type(lookup_value) is int and lookup_value >= 0:
+            template = self._get_url_template(view_name, request, format)
+            if template is not None:
+                return template[0] + str(lookup_value) + template[1]
+
         kwargs = {self.lookup_url_kwarg: lookup_value}
         return self.reverse(view_name, kwargs=kwargs, request=request, format=format)
 
+    def _get_url_template(self, view_name, request, format):
+        templates = self.__dict__.get('_url_templates')
+
+        if templates is None or self._url_templates_request is not request:
+            templates = self._url_templates = {}
+            self._url_templates_request = request
+
+        key = (view_name, format)
+
+        if key not in templates:
+            kwargs = {self.lookup_url_kwarg: self.url_template_sentinel}
+            try:
+                url = self.reverse(view_name, kwargs=kwargs, request=request, format=format)
+            except NoReverseMatch:
+                parts = None
+            else:
+                parts = url.split(str(self.url_template_sentinel))
+            # fall back to reverse() unless the value appears exactly once
+            templates[key] = tuple(parts) if parts is not None and len(parts) == 2 else None
+
+        return templates[key]
+
 
 class PrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
     """
@@ -30,6 +157,144 @@ class PrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
         return value if isinstance(value, int) else super().to_representation(value)
 
 
+class BatchedRelatedLookup:
+    """
+    Stands in for a related field's queryset while a payload is validated.
+    The keys collected from the payload are fetched with one __in query and
+    get() answers from memory, raising what QuerySet.get() would. Keys that
+    weren't collected fall back to the real queryset.
+    """
+    multiple = object()
+
+    def __init__(self, queryset, field_name, values):
+        self.queryset = queryset
+        self.model = queryset.model
+        self.model_field = self.model._meta.pk if field_name == 'pk' else self.model._meta.get_field(field_name)
+        self.keys = set()
+
+        for value in values:
+            try:
+                self.keys.add(self.model_field.get_prep_value(value))
+            except (TypeError, ValueError):
+                pass
+
+        self.objects = {}
+
+        for obj in queryset.filter(**{field_name + '__in': self.keys}):
+            key = self.model_field.get_prep_value(getattr(obj, self.model_field.attname))
+            self.objects[key] = self.multiple if key in self.objects else obj
+
+    def get(self, **kwargs):
+        (value,) = kwargs.values()
+        key = self.model_field.get_prep_value(value)
+
+        if key not in self.keys:
+            return self.queryset.get(**kwargs)
+
+        obj = self.objects.get(key)
+
+        if obj is None:
+            raise self.model.DoesNotExist('%s matching query does not exist.' % self.model._meta.object_name)
+        if obj is self.multiple:
+            raise self.model.MultipleObjectsReturned('get() returned more than one %s.' % self.model._meta.object_name)
+
+        return obj
+
+
+def get_batched_lookup_field(field):
+    """
+    Returns the model field name a PrimaryKeyRelatedField or SlugRelatedField
+    looks values up by, or None if its lookups can't be batched.
+    """
+    if field.read_only or field.queryset is None or isinstance(field.queryset, BatchedRelatedLookup):
+        return None
+    if type(field).get_queryset is not serializers.RelatedField.get_queryset:
+        return None
+    if type(field).to_internal_value is serializers.PrimaryKeyRelatedField.to_internal_value:
+        return 'pk'
+    if type(field).to_internal_value is serializers.SlugRelatedField.to_internal_value and '__' not in field.slug_field:
+        return field.slug_field
+    return None
+
+
+@contextmanager
+def batched_related_lookups(serializer, items, single_valued=True):
+    """
+    Swaps the queryset of the serializer's related fields, and of the
+    children of its many related fields, for BatchedRelatedLookups over the
+    values found in `items`, restoring them on exit.
+    """
+    primed = []
+
+    try:
+        for field in serializer.fields.values():
+            many = isinstance(field, serializers.ManyRelatedField)
+            relation = field.child_relation if many else field
+
+            if not many and not single_valued:
+                continue
+
+            field_name = get_batched_lookup_field(relation) if isinstance(relation, serializers.RelatedField) else None
+
+            if field_name is None:
+                continue
+
+            values = []
+            for item in items:
+                value = item.get(field.field_name) if isinstance(item, Mapping) else None
+                if many and isinstance(value, list):
+                    values.extend(value)
+                elif not many and value is not None:
+                    values.append(value)
+
+            if values:
+                primed.append((relation, relation.queryset))
+                relation.queryset = BatchedRelatedLookup(relation.get_queryset(), field_name, values)
+
+        yield
+    finally:
+        for relation, queryset in primed:
+            relation.queryset = queryset
+
+
+class FlexFieldsListSerializer(serializers.ListSerializer):
+    """
+    Used for many=True unless Meta.list_serializer_class is set. Resolves the
+    child's row pipeline once and reuses it for every item, and validates
+    related keys of all items with one query per relation.
+    """
+    def to_internal_value(self, data):
+        items = data if isinstance(data, list) else []
+
+        with batched_related_lookups(self.child, items):
+            return super().to_internal_value(data)
+
+    def to_representation(self, data):
+        if self.parent is None:
+            with profile_phase('represent'):
+                return self._represent_items(data)
+        return self._represent_items(data)
+
+    def _represent_items(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        child = self.child
+
+        if type(child).to_representation is not FlexFieldsSerializerMixin.to_representation:
+            return [child.to_representation(item) for item in iterable]
+
+        pipeline = child._get_row_pipeline()
+
+        if child.cache_representations and child._get_representation_memo()[0] is None:
+            items = list(iterable)
+            if all(isinstance(item, models.Model) and item.pk is not None for item in items):
+                return child._build_representations(items, pipeline)
+
+        return [
+            child._represent_instance(item, pipeline) if not isinstance(item, Mapping) else child.to_representation(item)
+            for item in iterable
+        ]
+
+
 class FlexFieldsSerializerMixin:
     """
     A Serializer that takes additional arguments for "fields", "omit" and
@@ -38,79 +303,537 @@ class FlexFieldsSerializerMixin:
     """
     is_flex_field = True
 
+    # Build the fields of each serializer class once and give every instance
+    # clones of them, rebuilt from their arguments. Disable for serializers whose get_fields() or
+    # build_field() depend on the instance or its context.
+    use_field_template = True
+
+    # Allow views with serializer_pool_size set to reuse built trees of this
+    # serializer across requests. Only enable it if the fields it builds, and
+    # those of the serializers it expands, don't depend on the request, the
+    # user or anything else in the context: a pooled tree is rebound to a new
+    # context, never rebuilt.
+    poolable = False
+
+    # Let a view render the response with the serializer it built, without
+    # an instance, to plan the query, rather than building another one for
+    # the instance or page. Only enable it if the fields it builds, and those
+    # of the serializers it expands, don't depend on self.instance.
+    share_planning_serializer = False
+
+    # Set on the top-level serializer to reuse the representation of a
+    # related object expanded more than once in the same response. Reused
+    # representations are copied unless copy_memoized_representations is
+    # False, and a nested serializer can add a model field such as
+    # 'updated_at' to the memo key with representation_version_field.
+    memoize_representations = False
+    copy_memoized_representations = True
+    representation_version_field = None
+
+    # Keep this serializer's representations across requests in
+    # representation_cache, invalidated when any model they embed changes.
+    # Only enable it for output that doesn't depend on the request.
+    cache_representations = False
+
+    # Budget for the expand tree requested from a root serializer, checked
+    # before any nested serializer is built. An expansion costs its 'cost'
+    # setting, or expand_many_cost for many=True expansions and 1 otherwise.
+    # Over-budget requests raise a ValidationError (400), or with
+    # expand_overflow = 'truncate' keep the expansions that fit, breadth
+    # first.
+    max_expand_depth = None
+    max_expand_nodes = None
+    max_expand_cost = None
+    expand_many_cost = 1
+    expand_overflow = 'reject'
+
     def __init__(self, *args, **kwargs):
+        with profile_phase('build'):
+            self._init_flex_fields(*args, **kwargs)
+
+    def _init_flex_fields(self, *args, **kwargs):
         passed = {
             'expand': kwargs.pop('expand', None),
             'fields': kwargs.pop('fields', None),
-            'omit': kwargs.pop('omit', []),
+            'omit': kwargs.pop('omit', None),
             'parent': kwargs.pop('parent', ''),
             'identifier': kwargs.pop('identifier', None)
         }
 
         # add excludes from expandable_fields to those on query params
-        passed['omit'] += kwargs.pop('exclude', [])
+        exclude = kwargs.pop('exclude', None)
+        if exclude:
+            passed['omit'] = FieldTree.parse(list(self._join_paths(passed['omit'])) + list(exclude))
 
         super(FlexFieldsSerializerMixin, self).__init__(*args, **kwargs)
         expand = self._get_expand_input(passed)
+
+        if not passed['parent'] and expand and self._has_expand_budget():
+            expand = self._apply_expand_budget(expand)
+
         fields = self._get_fields_input(passed)
         omit = self._get_omit_input(passed)
-        expand_field_names, next_expand_field_names = split_levels(expand)
-        sparse_field_names, next_sparse_field_names = split_levels(fields)
-        omit_field_names, next_omit_field_names = split_levels(omit)
-        omit_field_names = set(omit_field_names) - next_omit_field_names.keys()
-
-        expandable_fields_names = self._get_expandable_names(sparse_field_names, omit_field_names)
-        forced_expand_names = [name for name, field in self.fields.items() if isinstance(field, serializers.Serializer)]
         identifier = passed['identifier']
+        self._field_filter = self._get_field_filter(fields, omit)
 
         if identifier or self._can_access_request:
-            url_specific_fields = ('view_name', 'lookup_field', 'lookup_url_kwarg', 'format')
-            identifier = identifier or self.context['request'].query_params.get('identifier') or self.context['request'].data.get('identifier')
-            if identifier in ('id', 'name', 'reference'):
-                for name in self.related_fields:
-                    kwargs = {k: v for k, v in self.fields[name]._kwargs.items() if k not in url_specific_fields}
-                    new_related_field = PrimaryKeyRelatedField(**kwargs) if identifier == 'id' else SafeSlugRelatedField(identifier, **kwargs)
-                    self.fields[name] = new_related_field
-                for name in self.many_related_fields:
-                    kwargs = {k: v for k, v in self.fields[name].child_relation._kwargs.items() if k not in url_specific_fields}
-                    new_related_field = PrimaryKeyRelatedField(**kwargs) if identifier == 'id' else SafeSlugRelatedField(identifier, **kwargs)
-                    self.fields[name].child_relation = new_related_field
-                self.fields.pop('url', None)
-                self.fields.pop('verbose_url', None)
+            identifier = identifier or get_flex_params(self.context['request']).identifier or self.context['request'].data.get('identifier')
+
+        # get_fields() may depend on the request, so the fields it returned
+        # are part of the key
+        field_names = tuple(self.fields)
+        self._plan_key = (type(self), expand, fields, omit, identifier, field_names)
+        plan = self._get_field_plan(expand, fields, omit, identifier, field_names)
+
+        for name in plan.dropped_fields:
+            self.fields.pop(name)
+
+        if identifier in ('id', 'name', 'reference'):
+            for name in self.related_fields:
+                self.fields[name] = _clone_field(self._get_identifier_template(name, identifier))
+            for name in self.many_related_fields:
+                child_relation = _clone_field(self._get_identifier_template(name, identifier))
+                child_relation.bind(field_name='', parent=self.fields[name])
+                self.fields[name].child_relation = child_relation
+            self.fields.pop('url', None)
+            self.fields.pop('verbose_url', None)
+
+        for name in plan.expanded_fields:
+            self.fields[name] = self._make_expanded_field_serializer(
+                name, plan.nested_expand, plan.nested_fields, plan.nested_omit, identifier
+            )
+
+        profile = get_current_profile()
+
+        if profile is not None:
+            replaced = len(self.related_fields) + len(self.many_related_fields) if identifier in ('id', 'name', 'reference') else 0
+            profile.count('serializers')
+            profile.count('fields_dropped', len(plan.dropped_fields))
+            profile.count('fields_replaced', replaced + len(plan.expanded_fields))
+
+    def _get_field_filter(self, fields, omit):
+        """
+        Returns the (allowed names or None for all, omitted names) pair that
+        get_fields() applies, so fields outside ?fields= or in ?omit= are
+        never built. Returns None when every field is kept.
+        """
+        sparse_field_names, _ = fields.split_levels()
+        omit_field_names, next_omit_field_names = omit.split_levels()
+        omit_field_names = frozenset(omit_field_names) - next_omit_field_names.keys()
+
+        if not sparse_field_names or '*' in sparse_field_names:
+            sparse_field_names = None
+        else:
+            sparse_field_names = frozenset(sparse_field_names)
+
+        if sparse_field_names is None and not omit_field_names:
+            return None
+
+        return sparse_field_names, omit_field_names
+
+    def _is_field_allowed(self, name):
+        field_filter = self.__dict__.get('_field_filter')
+
+        if field_filter is None:
+            return True
+
+        allowed, omitted = field_filter
+        return (allowed is None or name in allowed) and name not in omitted
+
+    def get_field_names(self, declared_fields, info):
+        field_names = super(FlexFieldsSerializerMixin, self).get_field_names(declared_fields, info)
+        return self._filter_field_names(field_names)
+
+    def get_fields(self):
+        if self.use_field_template:
+            template = self._get_field_template()
+            return OrderedDict((name, _clone_field(template[name])) for name in self._filter_field_names(template))
+
+        fields = super(FlexFieldsSerializerMixin, self).get_fields()
+        return OrderedDict((name, fields[name]) for name in self._filter_field_names(fields))
+
+    def _get_field_template(self):
+        """
+        Returns the unbound fields of this serializer class, built by
+        ModelSerializer once per class and rebuilt only if the declared
+        fields change. Instances bind clones of them.
+        """
+        signature = self._get_fields_signature()
+        cached = field_templates_cache.get(type(self))
+
+        if cached is None or cached[0] != signature:
+            field_filter, self._field_filter = self.__dict__.get('_field_filter'), None
+            try:
+                cached = (signature, super(FlexFieldsSerializerMixin, self).get_fields())
+            finally:
+                self._field_filter = field_filter
+            field_templates_cache[type(self)] = cached
+
+        return cached[1]
+
+    def _filter_field_names(self, field_names):
+        allowed = [name for name in field_names if self._is_field_allowed(name)]
+        profile = get_current_profile()
+
+        if profile is not None:
+            profile.count('fields_dropped', len(field_names) - len(allowed))
+
+        return allowed
+
+    def _get_all_fields(self):
+        """
+        Returns every field of the serializer class, ignoring ?fields= and
+        ?omit=.
+        """
+        field_filter, self._field_filter = self.__dict__.get('_field_filter'), None
+
+        try:
+            return self.get_fields()
+        finally:
+            self._field_filter = field_filter
+
+    def _has_expand_budget(self):
+        return any(limit is not None for limit in (self.max_expand_depth, self.max_expand_nodes, self.max_expand_cost))
+
+    def _apply_expand_budget(self, expand):
+        """
+        Walks `expand` breadth first against the expandable_fields graph and
+        returns it unchanged if it fits max_expand_depth, max_expand_nodes and
+        max_expand_cost, the truncated tree if expand_overflow is 'truncate',
+        and otherwise raises a ValidationError.
+        """
+        kept, errors = [], []
+        nodes = cost = 0
+        queue = deque([(type(self), getattr(getattr(self, 'Meta', None), 'expandable_fields', {}), expand, ())])
+
+        while queue:
+            serializer_class, expandable_fields, tree, path = queue.popleft()
+            names, subtrees = tree.split_levels()
+            names = list(expandable_fields) if '*' in names else [name for name in names if name in expandable_fields]
+
+            for name in names:
+                expandable_field = get_expandable_field(serializer_class, expandable_fields, name)
+                node_cost = expandable_field.cost
+                if node_cost is None:
+                    node_cost = self.expand_many_cost if expandable_field.settings.get('many') else 1
+
+                node_path = path + (name,)
+                error = self._check_expand_budget(node_path, nodes + 1, cost + node_cost)
+
+                if error:
+                    errors.append(error)
+                    continue
+
+                nodes, cost = nodes + 1, cost + node_cost
+                kept.append('.'.join(node_path))
+                nested_class = expandable_field.serializer_class
+                nested_fields = getattr(getattr(nested_class, 'Meta', None), 'expandable_fields', {})
+                queue.append((nested_class, nested_fields, subtrees.get(name, FieldTree()), node_path))
+
+        if not errors:
+            return expand
+
+        if self.expand_overflow == 'truncate':
+            return FieldTree.parse(kept)
+
+        raise serializers.ValidationError({'expand': errors[:1]})
+
+    def _check_expand_budget(self, path, nodes, cost):
+        if self.max_expand_depth is not None and len(path) > self.max_expand_depth:
+            return 'Expanding "{}" exceeds the maximum depth of {}.'.format('.'.join(path), self.max_expand_depth)
+        if self.max_expand_nodes is not None and nodes > self.max_expand_nodes:
+            return 'Expanding "{}" exceeds the maximum of {} expanded fields.'.format('.'.join(path), self.max_expand_nodes)
+        if self.max_expand_cost is not None and cost > self.max_expand_cost:
+            return 'Expanding "{}" exceeds the maximum expansion cost of {}.'.format('.'.join(path), self.max_expand_cost)
+        return None
+
+    def _get_field_plan(self, expand, fields, omit, identifier, field_names):
+        """
+        Returns the cached FieldPlan for this serializer class, combination
+        of expand, fields, omit and identifier, and the names of the fields
+        get_fields() returned, compiling it on a miss.
+        """
+        key = (type(self), expand, fields, omit, identifier, field_names)
+        plan = field_plan_cache.get(key)
+
+        if plan is None:
+            plan = self._compile_field_plan(*key[1:4])
+            field_plan_cache.set(key, plan)
+
+        return plan
+
+    def _compile_field_plan(self, expand, fields, omit):
+        expand_field_names, next_expand_field_names = expand.split_levels()
+        sparse_field_names, next_sparse_field_names = fields.split_levels()
+        omit_field_names, next_omit_field_names = omit.split_levels()
+        omit_field_names = set(omit_field_names) - next_omit_field_names.keys()
+
+        dropped_field_names, expandable_fields_names = self._get_expandable_names(sparse_field_names, omit_field_names)
+        forced_expand_names = [name for name, field in self.fields.items() if isinstance(field, serializers.Serializer)]
 
         if '*' in expand_field_names:
             expand_field_names = self.expandable_fields.keys()
 
         resolved_expand_fields = set(expandable_fields_names) & (set(expand_field_names) | set(forced_expand_names))
 
-        for name in resolved_expand_fields:
-            self.fields[name] = self._make_expanded_field_serializer(
-                name, next_expand_field_names, next_sparse_field_names, next_omit_field_names, identifier
+        return FieldPlan(
+            dropped_fields=tuple(dropped_field_names),
+            expanded_fields=tuple(name for name in self.fields if name in resolved_expand_fields),
+            nested_expand=next_expand_field_names,
+            nested_fields=next_sparse_field_names,
+            nested_omit=next_omit_field_names,
+        )
+
+    @classmethod
+    def serialize_many(cls, queryset, workers=None, chunk_size=1000, executor_class=ThreadPoolExecutor, **kwargs):
+        """
+        Returns the same list as cls(queryset, many=True, **kwargs).data,
+        serialized in chunks of `chunk_size` primary keys by a pool of
+        `workers`. See iter_serialize_many().
+        """
+        return [
+            row for chunk in cls.iter_serialize_many(queryset, workers, chunk_size, executor_class, **kwargs)
+            for row in chunk
+        ]
+
+    @classmethod
+    def iter_serialize_many(cls, queryset, workers=None, chunk_size=1000, executor_class=ThreadPoolExecutor, **kwargs):
+        """
+        Yields the serialized rows of `queryset` one chunk at a time, in the
+        queryset's order. The primary keys are read first. Each chunk is then
+        fetched from `queryset` without its slice, so annotations and
+        select_related() are kept, with the query plan for the requested
+        expansions (which replaces any prefetch_related() on `queryset`), and
+        serialized by an `executor_class` worker on its own database
+        connection, which is closed when the chunk is done. Threads overlap
+        database round trips; pass ProcessPoolExecutor to also spread the
+        serialization itself over several cores. With workers=None or 1
+        everything runs in the calling thread.
+        """
+        pks = list(queryset.values_list('pk', flat=True))
+        chunks = [pks[i:i + chunk_size] for i in range(0, len(pks), chunk_size)]
+        # workers get the bare query: pickling a QuerySet would evaluate it.
+        # A slice has already picked the primary keys, so it is dropped.
+        base_query = queryset.query.clone()
+        base_query.clear_limits()
+        base_query.clear_ordering(force_empty=True)
+        queryset_class = type(queryset)
+        db = queryset.db
+
+        if not workers or workers == 1:
+            for chunk_pks in chunks:
+                yield _serialize_chunk(cls, queryset_class, base_query, db, chunk_pks, kwargs, close_connection=False)
+            return
+
+        if issubclass(executor_class, ProcessPoolExecutor):
+            # forked workers must not share the parent's open connections
+            connections[db].close()
+
+        with executor_class(max_workers=workers) as executor:
+            yield from executor.map(
+                _serialize_chunk, *zip(*[(cls, queryset_class, base_query, db, chunk_pks, kwargs, True) for chunk_pks in chunks])
             )
 
+    def to_internal_value(self, data):
+        # a single item only gains from batching its many related fields
+        with batched_related_lookups(self, [data], single_valued=False):
+            return super(FlexFieldsSerializerMixin, self).to_internal_value(data)
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_serializer = super().many_init(*args, **kwargs)
+
+        if type(list_serializer) is serializers.ListSerializer:
+            # no Meta.list_serializer_class was given, so use the flex-aware one
+            list_serializer.__class__ = FlexFieldsListSerializer
+
+        return list_serializer
+
+    def to_representation(self, instance):
+        if self.parent is None:
+            with profile_phase('represent'):
+                return self._represent(instance)
+        return self._represent(instance)
+
+    def _represent(self, instance):
+        if isinstance(instance, Mapping):
+            return super().to_representation(instance)
+        return self._represent_instance(instance, self._get_row_pipeline())
+
+    def _get_row_pipeline(self):
+        """
+        Compiles the readable fields into (name, attribute, field) steps once
+        per instance. `attribute` is set when the field reads a concrete model
+        column or foreign key, which is fetched with a plain getattr; other
+        fields go through field.get_attribute().
+        """
+        pipeline = self.__dict__.get('_row_pipeline')
+
+        if pipeline is None:
+            model = getattr(getattr(self, 'Meta', None), 'model', None)
+            pipeline = [
+                (field.field_name, self._get_plain_attribute(field, model), field)
+                for field in self.fields.values() if not field.write_only
+            ]
+            self._row_pipeline = pipeline
+
+        return pipeline
+
+    @staticmethod
+    def _get_plain_attribute(field, model):
+        if model is None or type(field).get_attribute is not serializers.Field.get_attribute or len(field.source_attrs) != 1:
+            return None
+
+        try:
+            model_field = model._meta.get_field(field.source_attrs[0])
+        except FieldDoesNotExist:
+            return None
+
+        if not model_field.concrete or model_field.many_to_many or field.source_attrs[0] not in (model_field.name, model_field.attname):
+            return None
+
+        return field.source_attrs[0]
+
+    def _represent_instance(self, instance, pipeline):
+        memo, copy_on_return = self._get_representation_memo()
+
+        if not isinstance(instance, models.Model) or instance.pk is None:
+            return self._represent_row(instance, pipeline)
+
+        if memo is None:
+            return self._build_representation(instance, pipeline)
+
+        version = getattr(instance, self.representation_version_field) if self.representation_version_field else None
+        key = (self._plan_key, instance._meta.label, instance.pk, version)
+        ret = memo.get(key)
+
+        if ret is None:
+            ret = memo[key] = self._build_representation(instance, pipeline)
+
+        return _copy_representation(ret) if copy_on_return else ret
+
+    def _build_representation(self, instance, pipeline):
+        if not self.cache_representations:
+            return self._represent_row(instance, pipeline)
+        return self._build_representations([instance], pipeline)[0]
+
+    def _build_representations(self, instances, pipeline):
+        if type(self) not in cached_serializer_classes:
+            register_cached_serializer(type(self))
+
+        return representation_cache.get_or_build_many(
+            self._plan_key, instances, lambda instance: self._represent_row(instance, pipeline)
+        )
+
+    def _get_representation_memo(self):
+        """
+        Returns the (memo, copy_on_return) pair shared by the serializers
+        below a root that opted in to memoize_representations, or (None,
+        False). Only expanded serializers use the memo: the rows of the root
+        serializer are never repeated.
+        """
+        try:
+            return self.__dict__['_representation_memo']
+        except KeyError:
+            pass
+
+        root = self.root
+        top = getattr(root, 'child', root)
+        memo = (None, False)
+
+        if self is not top and getattr(top, 'memoize_representations', False):
+            memo = (root.__dict__.setdefault('_representation_memo_store', {}), top.copy_memoized_representations)
+
+        self._representation_memo = memo
+        return memo
+
+    def _represent_row(self, instance, pipeline):
+        ret = OrderedDict()
+
+        for field_name, attribute_name, field in pipeline:
+            try:
+                if attribute_name is None:
+                    attribute = field.get_attribute(instance)
+                else:
+                    try:
+                        attribute = getattr(instance, attribute_name)
+                    except (AttributeError, ObjectDoesNotExist):
+                        attribute = field.get_attribute(instance)
+            except SkipField:
+                continue
+
+            check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+            ret[field_name] = None if check_for_none is None else field.to_representation(attribute)
+
+        return ret
+
     @property
     def related_fields(self):
-        NoneType = type(None)
-        related_fields = [k for k, v in self.fields.items() if isinstance(v, serializers.RelatedField) and not isinstance(v, serializers.HyperlinkedIdentityField)]
-        if hasattr(self, 'Meta') and hasattr(self.Meta, 'model'):
-            related_fields = [k for k in related_fields if not isinstance(getattr(self.Meta.model, k, None), (property, NoneType))]
-        return related_fields
+        related_fields, _ = self._get_class_related_fields()
+        return [k for k in related_fields if k in self.fields and not isinstance(self.fields[k], serializers.BaseSerializer)]
 
     @property
     def many_related_fields(self):
+        _, many_related_fields = self._get_class_related_fields()
+        return [k for k in many_related_fields if k in self.fields and not isinstance(self.fields[k], serializers.BaseSerializer)]
+
+    def _get_class_related_fields(self):
+        """
+        Returns the names of the single and many related fields declared for
+        this serializer class. They are computed once per class and only
+        recomputed if the declared fields change.
+        """
+        signature = self._get_fields_signature()
+        cached = related_fields_cache.get(type(self))
+
+        if cached is None or cached[0] != signature:
+            cached = (signature,) + self._compute_related_fields(self._get_all_fields())
+            related_fields_cache[type(self)] = cached
+            for identifier in ('id', 'name', 'reference'):
+                identifier_templates_cache.pop((type(self), identifier), None)
+
+        return cached[1:]
+
+    def _get_fields_signature(self):
+        meta = getattr(self, 'Meta', None)
+        return (
+            tuple(getattr(self, '_declared_fields', ())),
+            _freeze_option(getattr(meta, 'fields', None)),
+            _freeze_option(getattr(meta, 'exclude', None)),
+        )
+
+    def _get_identifier_template(self, name, identifier):
+        """
+        Returns an unbound PrimaryKeyRelatedField or SafeSlugRelatedField that
+        replaces the related field `name` for the given identifier. Templates
+        are built once per serializer class and cloned per instance.
+        """
+        templates = identifier_templates_cache.setdefault((type(self), identifier), {})
+
+        if name not in templates:
+            url_specific_fields = ('view_name', 'lookup_field', 'lookup_url_kwarg', 'format')
+            field = self.fields[name]
+            field = getattr(field, 'child_relation', field)
+            kwargs = {k: v for k, v in field._kwargs.items() if k not in url_specific_fields}
+            templates[name] = PrimaryKeyRelatedField(**kwargs) if identifier == 'id' else SafeSlugRelatedField(identifier, **kwargs)
+
+        return templates[name]
+
+    def _compute_related_fields(self, fields):
         NoneType = type(None)
-        many_related_fields = [k for k, v in self.fields.items() if isinstance(v, serializers.ManyRelatedField) and isinstance(v.child_relation, serializers.RelatedField)]
+        related_fields = [k for k, v in fields.items() if isinstance(v, serializers.RelatedField) and not isinstance(v, serializers.HyperlinkedIdentityField)]
+        many_related_fields = [k for k, v in fields.items() if isinstance(v, serializers.ManyRelatedField) and isinstance(v.child_relation, serializers.RelatedField)]
         if hasattr(self, 'Meta') and hasattr(self.Meta, 'model'):
+            related_fields = [k for k in related_fields if not isinstance(getattr(self.Meta.model, k, None), (property, NoneType))]
             many_related_fields = [k for k in many_related_fields if not isinstance(getattr(self.Meta.model, k, None), (property, NoneType))]
-        return many_related_fields
+        return tuple(related_fields), tuple(many_related_fields)
 
     def _make_expanded_field_serializer(self, name, nested_expands, nested_includes, nested_omits, identifier):
         """
         Returns an instance of the dynamically created nested serializer. 
         """
-        field_options = self.expandable_fields[name]
-        serializer_class = field_options[0]
-        serializer_settings = copy.deepcopy(field_options[1])
+        expandable_field = self._get_expandable_field(name)
+        serializer_settings = dict(expandable_field.settings)
         serializer_settings['parent'] = name
 
         if name in nested_expands:
@@ -122,15 +845,21 @@ class FlexFieldsSerializerMixin:
         if name in nested_omits:
             serializer_settings['omit'] = nested_omits[name]
 
-        if serializer_settings.get('source') == name:
-            del serializer_settings['source']
-
         serializer_settings['identifier'] = identifier
-        serializer_class = import_serializer_class(serializer_class)
-        assert getattr(serializer_class, 'is_flex_field', False), '{} does not support being an expandable_field; try inheriting from FlexFieldsSerializerMixin'.format(serializer_class)
-        return serializer_class(**serializer_settings)
+        return expandable_field.serializer_class(**serializer_settings)
+
+    def _get_expandable_field(self, name):
+        """
+        Returns the validated, read-only ExpandableField for `name`, built once
+        per serializer class.
+        """
+        return get_expandable_field(type(self), self.expandable_fields, name)
 
     def _get_expandable_names(self, sparse_field_names, omit_field_names):
+        """
+        Returns the names of the fields to drop and the names of the remaining
+        fields that may be expanded.
+        """
         field_names = set(self.fields.keys())
         expandable_field_names = set(self.expandable_fields.keys())
 
@@ -138,11 +867,8 @@ class FlexFieldsSerializerMixin:
             sparse_field_names = field_names
 
         allowed_field_names = set(sparse_field_names) - set(omit_field_names)
-
-        for field_name in field_names - allowed_field_names:
-            self.fields.pop(field_name)
-
-        return list(expandable_field_names & allowed_field_names)
+        dropped_field_names = [name for name in self.fields if name not in allowed_field_names]
+        return dropped_field_names, list(expandable_field_names & allowed_field_names)
 
     @property
     def expandable_fields(self):
@@ -156,13 +882,24 @@ class FlexFieldsSerializerMixin:
         value = passed_settings.get(param)
 
         if value:
-            return value
+            return to_field_tree(value)
 
         if not self._can_access_request:
-            return None
+            return FieldTree()
+
+        tree = getattr(get_flex_params(self.context['request']), param)
+        parent = passed_settings['parent']
 
-        fields = self.context['request'].query_params.get(param)
-        return [f for f in split_list(fields) if f.startswith(passed_settings['parent'])] if fields else None
+        if not parent:
+            return tree
+
+        return FieldTree.parse(path for path in self._join_paths(tree) if path.startswith(parent))
+
+    @staticmethod
+    def _join_paths(value):
+        if not isinstance(value, FieldTree):
+            return value or []
+        return ['.'.join(path) for path in value.paths()]
 
     def _get_omit_input(self, passed_settings):
         return self._get_sparse_input(passed_settings, 'omit')
@@ -174,15 +911,25 @@ class FlexFieldsSerializerMixin:
         return self._get_sparse_input(passed_settings, 'expand')
 
 
+serializer_class_registry = {}
+
+
 def import_serializer_class(location):
     """
     Resolves a dot-notation string to serializer class.
     <app>.<SerializerName> will automatically be interpreted as:
     <app>.serializers.<SerializerName>
+    Resolved classes are kept in serializer_class_registry, so each location
+    is only imported once per process.
     """
     if not isinstance(location, str):
         return location
 
+    try:
+        return serializer_class_registry[location]
+    except KeyError:
+        pass
+
     pieces = location.split('.')
     class_name = pieces.pop()
 
@@ -193,7 +940,135 @@ def import_serializer_class(location):
         pieces.append('serializers')
 
     module = importlib.import_module( '.'.join(pieces) )
-    return getattr(module, class_name)
+    serializer_class = getattr(module, class_name)
+    serializer_class_registry[location] = serializer_class
+    return serializer_class
+
+
+def warm_serializer_registry(serializer_classes=None):
+    """
+    Resolves every expandable_fields reference reachable from the given
+    serializer classes (by default, every flex serializer found in the
+    installed apps' serializers modules), so that the first requests don't pay
+    for imports. Unresolvable references raise ImproperlyConfigured; cycles in
+    the expansion graph are returned as lists of serializer classes.
+    """
+    if serializer_classes is None:
+        autodiscover_modules('serializers')
+        serializer_classes = _get_subclasses(FlexFieldsSerializerMixin)
+
+    graph = {}
+    pending = list(serializer_classes)
+
+    while pending:
+        serializer_class = pending.pop()
+        if serializer_class in graph:
+            continue
+
+        graph[serializer_class] = []
+        expandable_fields = getattr(getattr(serializer_class, 'Meta', None), 'expandable_fields', {})
+
+        for name, (location, settings) in expandable_fields.items():
+            for reference in (location, settings.get('base_serializer_class')):
+                if reference is None:
+                    continue
+                try:
+                    resolved = import_serializer_class(reference)
+                except (ImportError, AttributeError, ValueError) as e:
+                    raise ImproperlyConfigured(
+                        'Could not resolve expandable field "{}" on {}: {}'.format(name, serializer_class.__name__, e)
+                    )
+                graph[serializer_class].append(resolved)
+                pending.append(resolved)
+
+    return _find_cycles(graph)
+
+
+def get_expandable_field(serializer_class, expandable_fields, name):
+    cached = expandable_fields_cache.get(serializer_class)
+
+    if cached is None or cached[0] is not expandable_fields:
+        cached = (expandable_fields, {})
+        expandable_fields_cache[serializer_class] = cached
+
+    if name not in cached[1]:
+        location, settings = expandable_fields[name]
+        cached[1][name] = ExpandableField(name, location, settings)
+
+    return cached[1][name]
+
+
+def _serialize_chunk(serializer_class, queryset_class, query, db, pks, kwargs, close_connection):
+    try:
+        queryset = queryset_class(model=query.model, query=query, using=db)
+        plan = QueryPlan.build(serializer_class(**kwargs), query.model, identifier=kwargs.get('identifier'))
+        instances = plan.apply(queryset).in_bulk(pks)
+        return list(serializer_class([instances[pk] for pk in pks], many=True, **kwargs).data)
+    finally:
+        if close_connection:
+            connections[db].close()
+
+
+def get_representation_dependencies(serializer_class, seen=None):
+    """
+    Returns the models whose data can appear in a representation built by
+    `serializer_class`: every model related to its own, plus, through
+    expandable_fields, the expanded models and their dependencies.
+    """
+    seen = set() if seen is None else seen
+    model = getattr(getattr(serializer_class, 'Meta', None), 'model', None)
+
+    if serializer_class in seen or model is None:
+        return set()
+
+    seen.add(serializer_class)
+    dependencies = {field.related_model for field in model._meta.get_fields() if field.is_relation and field.related_model}
+
+    for expandable_class, settings in getattr(serializer_class.Meta, 'expandable_fields', {}).values():
+        expandable_class = import_serializer_class(expandable_class)
+        expandable_model = getattr(getattr(expandable_class, 'Meta', None), 'model', None)
+        if expandable_model is not None:
+            dependencies.add(expandable_model)
+        dependencies |= get_representation_dependencies(expandable_class, seen)
+
+    return dependencies
+
+
+def register_cached_serializer(serializer_class):
+    """
+    Registers the dependencies of a serializer with cache_representations
+    enabled, so saving or deleting any of them invalidates its entries.
+    """
+    representation_cache.register(serializer_class.Meta.model, get_representation_dependencies(serializer_class))
+    cached_serializer_classes.add(serializer_class)
+
+
+def _get_subclasses(cls):
+    subclasses = []
+    for subclass in cls.__subclasses__():
+        subclasses.append(subclass)
+        subclasses.extend(_get_subclasses(subclass))
+    return subclasses
+
+
+def _find_cycles(graph):
+    cycles = []
+    visited = set()
+
+    def visit(node, path):
+        if node in path:
+            cycles.append(path[path.index(node):])
+            return
+        if node in visited:
+            return
+        visited.add(node)
+        for child in graph.get(node, []):
+            visit(child, path + [node])
+
+    for node in graph:
+        visit(node, [])
+
+    return cycles
 
 
 class FlexFieldsModelSerializer(FlexFieldsSerializerMixin, serializers.ModelSerializer):
@@ -1,3 +1,7 @@
+from collections import namedtuple
+from .profiling import profile_phase as _profile_phase
+
+
 def split_list(param):
     return param.replace(',', ' ').split()  # split(',') doesn't handle empty or whitespace gracefully
 
@@ -26,6 +30,82 @@ def split_levels(fields):
     return first_level_fields, next_level_fields
 
 
+class FieldTree(tuple):
+    """
+        An immutable trie of dot-notation fields, stored as sorted
+        (name, subtree) pairs so that equal trees are equal and hashable.
+
+        >>> FieldTree.parse(['a', 'a.b', 'a.d', 'c'])
+        (('a', (('b', ()), ('d', ()))), ('c', ()))
+    """
+    @classmethod
+    def parse(cls, fields):
+        nested = {}
+
+        for e in fields or ():
+            node = nested
+            for part in e.split('.'):
+                node = node.setdefault(part, {})
+
+        return cls._freeze(nested)
+
+    @classmethod
+    def _freeze(cls, nested):
+        return cls((name, cls._freeze(children)) for name, children in sorted(nested.items()))
+
+    def split_levels(self):
+        """
+            The trie equivalent of split_levels: returns current-level names
+            and a dict of the non-empty next-level subtrees.
+
+            >>> FieldTree.parse(['a', 'a.b', 'c']).split_levels()
+            (['a', 'c'], {'a': (('b', ()),)})
+        """
+        return [name for name, _ in self], {name: children for name, children in self if children}
+
+    def paths(self, prefix=()):
+        """
+            Yields the leaf paths of the trie as tuples of names.
+
+            >>> list(FieldTree.parse(['a', 'a.b', 'c']).paths())
+            [('a', 'b'), ('c',)]
+        """
+        for name, children in self:
+            if children:
+                yield from children.paths(prefix + (name,))
+            else:
+                yield prefix + (name,)
+
+
+def to_field_tree(value):
+    return value if isinstance(value, FieldTree) else FieldTree.parse(value)
+
+
+FlexParams = namedtuple('FlexParams', ['expand', 'fields', 'omit', 'identifier'])
+
+
+def get_flex_params(request):
+    """
+    Parses the expand, fields, omit and identifier query params into FieldTrees
+    once per request; the result is stored on the request and shared by every
+    serializer and viewset method handling it.
+    """
+    params = getattr(request, '_flex_params', None)
+
+    if params is None:
+        with _profile_phase('parse'):
+            query_params = request.query_params
+            params = FlexParams(
+                expand=FieldTree.parse(get_list_query_param(query_params, 'expand')),
+                fields=FieldTree.parse(get_list_query_param(query_params, 'fields')),
+                omit=FieldTree.parse(get_list_query_param(query_params, 'omit')),
+                identifier=query_params.get('identifier')
+            )
+            request._flex_params = params
+
+    return params
+
+
 def get_list_query_param(query_params, param, default=None):
     """
     >>> get_list_query_param({'foo': 'a,b,c'}, 'foo')
@@ -1,66 +1,429 @@
 """ 
 This class determines how to optimize ViewSet queries when expanding fields.
 """
-from django.db.models import ForeignKey, ManyToManyField, ManyToOneRel, OneToOneRel
-from django.core.exceptions import FieldDoesNotExist
-from rest_framework import viewsets
-from .serializers import import_serializer_class
-from .utils import split_list
+import hashlib
+import warnings
+from calendar import timegm
+from contextlib import ExitStack
+from django.db import connections
+from django.db.models import Count, Max, prefetch_related_objects
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework import serializers, viewsets
+from rest_framework.generics import get_object_or_404
+from rest_framework.permissions import SAFE_METHODS, BasePermission
+from rest_framework.renderers import BrowsableAPIRenderer, JSONRenderer
+from rest_framework.response import Response
+from .pool import bind, serializer_pool
+from .profiling import RequestProfile, get_current_profile, profile_phase, request_profiled
+from .projection import ValuesProjection
+from .query_plan import QueryPlan
+from .serializers import FlexFieldsListSerializer
+from .utils import get_flex_params
 
 
 class FlexFieldsMixin:
+    # Serve list and retrieve from queryset.values() when every requested
+    # field can be projected, skipping model instantiation.
+    use_values_projection = False
+
+    # Stream unpaginated lists row by row, as a JSON array or as NDJSON,
+    # fetching (and prefetching) `stream_chunk_size` rows at a time.
+    stream_list = False
+    stream_format = 'json'
+    stream_chunk_size = 1000
+
+    # Name of a timestamp field, such as 'updated_at', kept up to date on
+    # the viewset's model and on expanded models. When set, list and
+    # retrieve responses carry ETag and Last-Modified headers and answer
+    # conditional requests with 304 Not Modified before serializing.
+    last_modified_field = None
+
+    # Time the parse, build, plan, sql and represent phases of each request
+    # and send them with the request_profiled signal. The breakdown is also
+    # returned in a Server-Timing header, and under profile_debug_key in
+    # dict response bodies if that is set.
+    profile_requests = False
+    profile_server_timing = True
+    profile_debug_key = None
+
+    # Keep up to this many built serializer trees per combination of
+    # serializer class, expand, fields, omit, identifier and many, and reuse
+    # them for later GET requests instead of building new ones. Only
+    # serializer classes that set poolable = True are pooled.
+    serializer_pool_size = 0
+
+    def dispatch(self, request, *args, **kwargs):
+        if not self.profile_requests:
+            return super().dispatch(request, *args, **kwargs)
+
+        profile = RequestProfile()
+
+        with ExitStack() as stack:
+            stack.enter_context(profile.activate())
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(profile.execute_wrapper))
+            response = super().dispatch(request, *args, **kwargs)
+
+        if self.profile_server_timing:
+            response['Server-Timing'] = profile.server_timing()
+
+        if self.profile_debug_key and isinstance(getattr(response, 'data', None), dict):
+            response.data[self.profile_debug_key] = profile.as_dict()
+
+        request_profiled.send(sender=type(self), profile=profile, request=self.request)
+        return response
+
+    def get_serializer(self, *args, **kwargs):
+        key = self._get_serializer_pool_key(args, kwargs)
+
+        if key is None:
+            serializer = self._take_request_serializer(args, kwargs)
+            return serializer if serializer is not None else super().get_serializer(*args, **kwargs)
+
+        serializer = serializer_pool.acquire(key)
+
+        if serializer is None:
+            serializer = super().get_serializer(*args, **kwargs)
+        else:
+            bind(serializer, args[0] if args else None, self.get_serializer_context())
+
+        self.__dict__.setdefault('_pooled_serializers', []).append((key, serializer))
+        return serializer
+
+    def get_request_serializer(self):
+        """
+        Returns the serializer for the current request without an instance,
+        built once and shared by query planning and projection. If the
+        serializer class sets share_planning_serializer, the first
+        get_serializer() call for an instance or a page takes it over
+        instead of building another tree.
+        """
+        serializer = self.__dict__.get('_request_serializer')
+
+        if serializer is None:
+            serializer = self._request_serializer = self.get_serializer()
+
+        return serializer
+
+    def _take_request_serializer(self, args, kwargs):
+        serializer = self.__dict__.get('_request_serializer')
+
+        if serializer is None or len(args) > 1 or set(kwargs) - {'many'}:
+            return None
+
+        if not args:
+            return None if kwargs.get('many') else serializer
+
+        # its fields were built without the instance
+        if not getattr(serializer, 'share_planning_serializer', False):
+            return None
+
+        del self._request_serializer
+
+        if not kwargs.get('many'):
+            serializer.instance = args[0]
+            return serializer
+
+        # what many_init() would build around a new child
+        meta = getattr(serializer, 'Meta', None)
+        list_serializer_class = getattr(meta, 'list_serializer_class', serializers.ListSerializer)
+
+        if list_serializer_class is serializers.ListSerializer and getattr(serializer, 'is_flex_field', False):
+            list_serializer_class = FlexFieldsListSerializer
+
+        return list_serializer_class(args[0], child=serializer, context=serializer._context)
+
+    def _get_serializer_pool_key(self, args, kwargs):
+        if not self.serializer_pool_size or self.request.method not in SAFE_METHODS or len(args) > 1:
+            return None
+        serializer_class = self.get_serializer_class()
+
+        if set(kwargs) - {'many'} or not getattr(serializer_class, 'poolable', False):
+            return None
+
+        params = get_flex_params(self.request)
+        return (serializer_class, params.expand, params.fields, params.omit, params.identifier, kwargs.get('many', False))
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        pooled = self.__dict__.pop('_pooled_serializers', ())
+
+        # the browsable API renders with response.data.serializer after this
+        if not isinstance(getattr(request, 'accepted_renderer', None), BrowsableAPIRenderer):
+            for key, serializer in pooled:
+                serializer_pool.release(key, serializer, self.serializer_pool_size)
+
+        return response
+
+    def get_query_plan(self, serializer=None):
+        """
+        Returns the QueryPlan for the current request: the deduplicated
+        select_related lookups, Prefetch objects and only() columns needed by
+        the expanded, sparse serializer.
+        """
+        serializer = serializer or self.get_request_serializer()
+        model = getattr(getattr(serializer, 'Meta', None), 'model', None)
+
+        if model is None:
+            return None
+
+        with profile_phase('plan'):
+            plan = QueryPlan.build(
+                serializer,
+                model,
+                identifier=get_flex_params(self.request).identifier,
+                prune_columns=self.request.method in SAFE_METHODS
+            )
+
+        profile = get_current_profile()
+
+        if profile is not None:
+            profile.record_query_plan(plan)
+
+        return plan
+
     def expand_field(self, field, queryset, serializer=None, query_parts=None, sluggify_fields=False):
-        field_parts = field.split('.') if field else []
-        serializer = serializer or self.get_serializer()
-        simple_slugs = serializer.related_fields if sluggify_fields else []
-        many_slugs = serializer.many_related_fields if sluggify_fields else []
-        query_parts = query_parts or []
-        django_obj = queryset
-        select_related_type = None
-
-        queryset = queryset.select_related(*simple_slugs)
-        queryset = queryset.prefetch_related(*many_slugs)
-
-        for idx, field in enumerate(field_parts):
-            if field == '*':
-                for f in serializer.expandable_fields.keys():
-                    queryset = self.expand_field(f, queryset, serializer, query_parts, sluggify_fields)
-
-            if field not in serializer.expandable_fields:
-                break
-
-            source_field = serializer[field].source
-            serializer_class, serializer_settings = serializer.expandable_fields[field]
-            serializer_class = import_serializer_class(serializer_class)
-            serializer = import_serializer_class(serializer_settings.get('base_serializer_class', serializer_class))()
-
-            try:
-                django_obj = django_obj.related_model._meta.get_field(source_field) if idx else django_obj.model._meta.get_field(source_field)
-            except FieldDoesNotExist:
-                break
-            else:
-                query_parts.append(field)
-                if isinstance(django_obj, (ManyToOneRel, ManyToManyField)):
-                    select_related_type = 'prefetch_related'
-                elif isinstance(django_obj, (OneToOneRel, ForeignKey)) and not select_related_type:
-                    select_related_type = 'select_related'
-
-        related_field = '__'.join(query_parts)
-        if select_related_type:
-            queryset = getattr(queryset, select_related_type)(related_field)
-        return queryset
+        """
+        Deprecated: use get_query_plan(). Returns `queryset` with the
+        select_related and prefetch lookups QueryPlan plans for expanding
+        `field` (a dotted path or '*') on `serializer`, by default the
+        view's serializer class. `query_parts` is ignored.
+        """
+        warnings.warn(
+            'FlexFieldsMixin.expand_field() is deprecated; use get_query_plan() instead.', DeprecationWarning, stacklevel=2
+        )
+        serializer_class = type(serializer) if serializer is not None else self.get_serializer_class()
+        identifier = 'name' if sluggify_fields else None
+        plan = QueryPlan.build(
+            serializer_class(expand=[field] if field else [], identifier=identifier), queryset.model,
+            identifier=identifier, prune_columns=False
+        )
+        return plan.apply(queryset)
 
     def get_queryset(self):
         queryset = super().get_queryset()
-        expand = self.request.query_params.get('expand', '')
-        sluggify_fields = self.request.query_params.get('identifier') in ('name', 'reference')
-        force_sluggify_list = [None] if sluggify_fields else []
 
-        for field in split_list(expand) + force_sluggify_list:
+        if type(self).expand_field is not FlexFieldsMixin.expand_field:
+            return self._expand_fields_with_override(queryset)
+
+        plan = self.get_query_plan()
+
+        if plan is None or plan.model is not queryset.model:
+            return queryset
+
+        return plan.apply(queryset)
+
+    def _expand_fields_with_override(self, queryset):
+        # subclasses overriding expand_field() keep being called per expansion
+        warnings.warn(
+            'Overriding FlexFieldsMixin.expand_field() is deprecated; override get_query_plan() instead.',
+            DeprecationWarning
+        )
+        params = get_flex_params(self.request)
+        sluggify_fields = params.identifier in ('name', 'reference')
+        fields = ['.'.join(path) for path in params.expand.paths()] + ([None] if sluggify_fields else [])
+
+        for field in fields:
             queryset = self.expand_field(field, queryset, sluggify_fields=sluggify_fields)
 
         return queryset
 
+    def get_values_projection(self, serializer=None):
+        """
+        Returns the ValuesProjection for the current request, or None if the
+        values() mode is disabled, the request isn't a read or some requested
+        field can't be projected.
+        """
+        if not self.use_values_projection or self.request.method not in SAFE_METHODS:
+            return None
+
+        serializer = serializer or self.get_request_serializer()
+        model = getattr(getattr(serializer, 'Meta', None), 'model', None)
+        return ValuesProjection.build(serializer, model) if model is not None else None
+
+    def get_values_queryset(self, projection):
+        queryset = self.filter_queryset(self.get_queryset())
+        return queryset.prefetch_related(None).values(*projection.lookups)
+
+    def list(self, request, *args, **kwargs):
+        if not self._is_conditional():
+            return self._list(request, *args, **kwargs)
+
+        return self.respond_conditionally(
+            self.filter_queryset(self.get_queryset()), lambda: self._list(request, *args, **kwargs)
+        )
+
+    def _list(self, request, *args, **kwargs):
+        projection = self.get_values_projection()
+
+        if self.stream_list and self.paginator is None:
+            return self.get_streaming_response(projection)
+
+        if projection is None:
+            return super().list(request, *args, **kwargs)
+
+        queryset = self.get_values_queryset(projection)
+        page = self.paginate_queryset(queryset)
+
+        if page is not None:
+            return self.get_paginated_response([projection.to_representation(row) for row in page])
+
+        return Response([projection.to_representation(row) for row in queryset])
+
+    def respond_conditionally(self, queryset, respond, detail=False):
+        """
+        Returns 304 Not Modified if the request's validators match those of
+        `queryset`, and otherwise respond() with ETag and Last-Modified set.
+        With `detail`, `queryset` holds the requested object.
+        """
+        validators = self.get_validators(queryset, detail)
+
+        if validators is None:
+            return respond()
+
+        etag, last_modified = validators
+        response = get_conditional_response(self.request._request, etag=etag, last_modified=last_modified)
+
+        if response is None:
+            response = respond()
+
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+
+        return response
+
+    def get_validators(self, queryset, detail=False):
+        """
+        Returns the (ETag, Last-Modified timestamp) pair for serializing
+        `queryset` with the current request's parameters, or None. Both come
+        from a single aggregate of the row count and latest
+        last_modified_field over the queryset and every relation the query
+        plan joins or prefetches. An empty `detail` queryset has none, so
+        a missing object is answered with 404 rather than matching
+        If-None-Match: *.
+        """
+        if not self._is_conditional():
+            return None
+
+        plan = self.get_query_plan()
+        paths = [('', queryset.model)] + ([(path + '__', model) for path, model in plan.relation_paths()] if plan else [])
+        aggregates = {}
+
+        for i, (path, model) in enumerate(paths):
+            if any(field.name == self.last_modified_field for field in model._meta.concrete_fields):
+                aggregates['modified_%d' % i] = Max(path + self.last_modified_field)
+            aggregates['count_%d' % i] = Count(path + 'pk', distinct=True)
+
+        values = queryset.prefetch_related(None).order_by().aggregate(**aggregates)
+
+        if detail and not values['count_0']:
+            return None
+
+        modified = [value for key, value in values.items() if key.startswith('modified_') and value is not None]
+        last_modified = timegm(max(modified).utctimetuple()) if modified else None
+
+        params = get_flex_params(self.request)
+        other_params = sorted(
+            (key, value) for key, value in self.request.query_params.lists() if key not in params._fields
+        )
+        renderer = getattr(self.request, 'accepted_renderer', None)
+        fingerprint = repr((sorted(values.items()), tuple(params), other_params, getattr(renderer, 'format', None)))
+        return quote_etag(hashlib.md5(fingerprint.encode()).hexdigest()), last_modified
+
+    def _is_conditional(self):
+        return self.last_modified_field is not None and self.request.method in ('GET', 'HEAD')
+
+    def _checks_object_permissions(self):
+        return any(
+            type(permission).has_object_permission is not BasePermission.has_object_permission
+            for permission in self.get_permissions()
+        )
+
+    def get_streaming_response(self, projection=None):
+        if self.stream_format == 'ndjson':
+            content, content_type = self._stream_ndjson(projection), 'application/x-ndjson'
+        else:
+            content, content_type = self._stream_json_array(projection), 'application/json'
+
+        return StreamingHttpResponse(content, content_type=content_type)
+
+    def iter_representations(self, projection=None):
+        """
+        Yields the representation of every row in the filtered queryset,
+        holding at most `stream_chunk_size` instances in memory at a time.
+        """
+        if projection is not None:
+            for row in self.get_values_queryset(projection).iterator(chunk_size=self.stream_chunk_size):
+                yield projection.to_representation(row)
+            return
+
+        queryset = self.filter_queryset(self.get_queryset())
+        prefetch_lookups = queryset._prefetch_related_lookups
+        serializer = self.get_request_serializer()
+        chunk = []
+
+        # iterator() ignores prefetch_related(), so each chunk is prefetched here
+        for instance in queryset.prefetch_related(None).iterator(chunk_size=self.stream_chunk_size):
+            chunk.append(instance)
+            if len(chunk) == self.stream_chunk_size:
+                yield from self._represent_chunk(serializer, chunk, prefetch_lookups)
+                chunk = []
+
+        yield from self._represent_chunk(serializer, chunk, prefetch_lookups)
+
+    def _represent_chunk(self, serializer, chunk, prefetch_lookups):
+        if chunk and prefetch_lookups:
+            prefetch_related_objects(chunk, *prefetch_lookups)
+        for instance in chunk:
+            yield serializer.to_representation(instance)
+
+    def _stream_json_array(self, projection):
+        renderer = JSONRenderer()
+        separator = b'['
+
+        for data in self.iter_representations(projection):
+            yield separator + renderer.render(data)
+            separator = b','
+
+        yield b']' if separator == b',' else b'[]'
+
+    def _stream_ndjson(self, projection):
+        renderer = JSONRenderer()
+
+        for data in self.iter_representations(projection):
+            yield renderer.render(data) + b'\n'
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        filter_kwargs = {self.lookup_field: self.kwargs[lookup_url_kwarg]}
+
+        if not self._is_conditional():
+            return self._retrieve(request, filter_kwargs, *args, **kwargs)
+
+        if self._checks_object_permissions():
+            # a 304 must not reveal objects the request may not see
+            instance = self.get_object()
+            respond = lambda: Response(self.get_serializer(instance).data)
+        else:
+            respond = lambda: self._retrieve(request, filter_kwargs, *args, **kwargs)
+
+        return self.respond_conditionally(
+            self.filter_queryset(self.get_queryset()).filter(**filter_kwargs), respond, detail=True
+        )
+
+    def _retrieve(self, request, filter_kwargs, *args, **kwargs):
+        projection = self.get_values_projection()
+
+        if projection is None or self._checks_object_permissions():
+            return super().retrieve(request, *args, **kwargs)
+
+        row = get_object_or_404(self.get_values_queryset(projection), **filter_kwargs)
+        return Response(projection.to_representation(row))
+
 
 class FlexFieldsModelViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
     pass
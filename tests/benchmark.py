@@ -0,0 +1,180 @@
+"""
+Measures the cost of flex-field requests against the test app on SQLite.
+
+    python -m tests.benchmark --sizes 10,100,1000,10000 --output results.json
+
+For every list size and scenario this reports serializer construction time
+(including query planning), to_representation time (including query
+execution), query count and peak traced memory, as a table on stderr and as
+JSON on stdout or --output.
+"""
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+import tests  # noqa: F401 -- configures Django
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, setup_test_environment
+from rest_framework import serializers
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from rest_flex_fields.serializers import HyperlinkedRelatedField
+from tests.testapp.models import Company, Person, Pet
+from tests.testapp.serializers import PersonWithPetsSerializer, PetSerializer
+from tests.testapp.views import PersonViewSet, PetViewSet
+
+
+class LinkedPetSerializer(PetSerializer):
+    owner = HyperlinkedRelatedField(view_name='person-detail', read_only=True)
+
+
+class ReversedPetSerializer(PetSerializer):
+    owner = serializers.HyperlinkedRelatedField(view_name='person-detail', read_only=True)
+
+
+class LinkedPersonSerializer(PersonWithPetsSerializer):
+    pets = HyperlinkedRelatedField(view_name='pet-detail', many=True, read_only=True)
+
+
+class ReversedPersonSerializer(PersonWithPetsSerializer):
+    pets = serializers.HyperlinkedRelatedField(view_name='pet-detail', many=True, read_only=True)
+
+
+class LinkedPetViewSet(PetViewSet):
+    serializer_class = LinkedPetSerializer
+
+
+class ReversedPetViewSet(PetViewSet):
+    serializer_class = ReversedPetSerializer
+
+
+class LinkedPersonViewSet(PersonViewSet):
+    serializer_class = LinkedPersonSerializer
+    queryset = Person.objects.prefetch_related('pets')
+
+
+class ReversedPersonViewSet(LinkedPersonViewSet):
+    serializer_class = ReversedPersonSerializer
+
+
+SCENARIOS = [
+    ('pets/depth-0', PetViewSet, ''),
+    ('pets/depth-1', PetViewSet, 'expand=owner'),
+    ('pets/depth-2', PetViewSet, 'expand=owner.employer'),
+    ('people/depth-3', PersonViewSet, 'expand=pets.owner.employer'),
+    ('pets/wildcard', PetViewSet, 'expand=*'),
+    ('people/wildcard', PersonViewSet, 'expand=*'),
+    ('pets/sparse', PetViewSet, 'fields=name'),
+    ('pets/sparse-depth-2', PetViewSet, 'expand=owner.employer&fields=name,owner.employer.name'),
+    ('pets/omit', PetViewSet, 'omit=toys,species'),
+    ('pets/identifier-id', PetViewSet, 'identifier=id&expand=owner'),
+    ('pets/identifier-name', PetViewSet, 'identifier=name'),
+    ('people/identifier-name', PersonViewSet, 'identifier=name'),
+    # memoized URL templates against DRF's per-object reverse()
+    ('pets/links', LinkedPetViewSet, ''),
+    ('pets/links-reverse', ReversedPetViewSet, ''),
+    ('people/links-many', LinkedPersonViewSet, ''),
+    ('people/links-many-reverse', ReversedPersonViewSet, ''),
+]
+
+
+def populate(size):
+    """
+    Creates `size` pets and `size` people: every person owns two pets, ten
+    people share each company.
+    """
+    Pet.objects.all().delete()
+    Person.objects.all().delete()
+    Company.objects.all().delete()
+
+    Company.objects.bulk_create(
+        Company(id=i + 1, name='company %d' % i) for i in range(max(1, size // 10))
+    )
+    Person.objects.bulk_create(
+        Person(id=i + 1, name='person %d' % i, hobbies='sailing', employer_id=i // 10 + 1) for i in range(size)
+    )
+    Pet.objects.bulk_create(
+        Pet(id=i + 1, name='pet %d' % i, toys='string', species='cat', owner_id=i // 2 + 1) for i in range(size)
+    )
+
+
+def run_scenario(viewset_class, query, size):
+    """
+    Serializes one list request; planning the queryset counts as construction.
+    """
+    factory = APIRequestFactory()
+    request = Request(factory.get('/?' + query))
+    view = viewset_class(request=request, format_kwarg=None, action='list')
+
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        queryset = view.filter_queryset(view.get_queryset())[:size]
+        serializer = view.get_serializer(queryset, many=True)
+        constructed = time.perf_counter()
+        data = serializer.data
+        represented = time.perf_counter()
+
+    assert len(data) == size
+    return {
+        'construct_ms': (constructed - started) * 1000,
+        'represent_ms': (represented - constructed) * 1000,
+        'queries': len(queries),
+    }
+
+
+def measure_peak_memory(viewset_class, query, size):
+    tracemalloc.start()
+    try:
+        run_scenario(viewset_class, query, size)
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def run(sizes, repeat=3, scenarios=SCENARIOS):
+    results = []
+
+    for size in sizes:
+        populate(size)
+        for name, viewset_class, query in scenarios:
+            runs = [run_scenario(viewset_class, query, size) for _ in range(repeat)]
+            result = {'scenario': name, 'query': query, 'size': size}
+            result.update({key: min(run[key] for run in runs) for key in runs[0]})
+            result['peak_kib'] = measure_peak_memory(viewset_class, query, size)
+            results.append(result)
+            print(
+                '{scenario:<24} {size:>6} rows  construct {construct_ms:9.2f}ms  represent {represent_ms:9.2f}ms  '
+                'queries {queries:>3}  peak {peak_kib:10.1f}KiB'.format(**result),
+                file=sys.stderr
+            )
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='10,100,1000,10000', help='comma-separated list sizes')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per scenario; the fastest is reported')
+    parser.add_argument('--scenario', action='append', help='only run scenarios whose name starts with this')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    setup_test_environment()
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+    scenarios = [s for s in SCENARIOS if not args.scenario or any(s[0].startswith(p) for p in args.scenario)]
+    results = run([int(size) for size in args.sizes.split(',')], args.repeat, scenarios)
+    output = json.dumps(results, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
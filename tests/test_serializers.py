@@ -1,6 +1,19 @@
+import re
 import pytest
+from django.apps import apps
+from django.core import checks
+from rest_framework import serializers
+from rest_framework.request import Request
+from rest_framework.reverse import reverse
+from rest_framework.test import APIRequestFactory
 from tests.testapp.models import Pet, Person, Company
-from tests.testapp.serializers import PetSerializer
+from rest_flex_fields import FieldTree, get_flex_params
+from rest_flex_fields import FlexFieldsModelSerializer
+from rest_flex_fields.serializers import (
+    FlexFieldsListSerializer, HyperlinkedRelatedField, field_plan_cache, import_serializer_class, related_fields_cache, serializer_class_registry,
+    warm_serializer_registry
+)
+from tests.testapp.serializers import PetSerializer, PersonSerializer, PersonWithPetsSerializer
 
 
 class MockRequest:
@@ -174,3 +187,307 @@ def test_nested_expand(expand):
             }
         }
     }
+
+
+def test_field_plan_is_cached():
+    field_plan_cache.clear()
+    pet = Pet(
+        name='Garfield',
+        toys='paper ball, string',
+        species='cat',
+        owner=Person(name='Fred', hobbies='sailing', employer=Company(name='McDonalds'))
+    )
+
+    first = PetSerializer(pet, expand=['owner.employer'], fields=['name', 'owner'])
+    assert field_plan_cache.info().misses == 3
+
+    second = PetSerializer(pet, expand=['owner.employer'], fields=['owner', 'name'])
+    assert field_plan_cache.info().hits == 3
+    assert field_plan_cache.info().misses == 3
+    assert first.data == second.data == {
+        'name': 'Garfield',
+        'owner': {
+            'name': 'Fred',
+            'hobbies': 'sailing',
+            'employer': {
+                'public': False,
+                'name': 'McDonalds'
+            }
+        }
+    }
+
+
+def test_field_plan_follows_request_dependent_fields():
+    class StaffOwnerSerializer(PetSerializer):
+        def get_fields(self):
+            fields = super().get_fields()
+            if not self.context.get('staff'):
+                fields.pop('owner', None)
+            return fields
+
+    pet = Pet(name='Garfield', toys='paper ball, string', species='cat', owner=Person(name='Fred', hobbies='sailing'))
+
+    staff = StaffOwnerSerializer(pet, expand=['owner'], context={'staff': True})
+    assert staff.data['owner'] == {'name': 'Fred', 'hobbies': 'sailing', 'employer': None}
+    assert 'owner' not in StaffOwnerSerializer(pet, expand=['owner']).data
+
+
+def test_request_params_parsed_once():
+    pet = Pet(
+        name='Garfield',
+        toys='paper ball, string',
+        species='cat',
+        owner=Person(name='Fred', hobbies='sailing', employer=Company(name='McDonalds'))
+    )
+
+    request = MockRequest(query_params={'expand': 'owner.employer', 'fields': 'owner.employer.name', 'identifier': 'id'})
+    params = get_flex_params(request)
+    assert params.expand == FieldTree.parse(['owner.employer'])
+    assert get_flex_params(request) is params
+
+    serializer = PetSerializer(pet, context={'request': request})
+    assert serializer.data == {
+        'owner': {
+            'employer': {
+                'name': 'McDonalds'
+            }
+        }
+    }
+
+
+def test_warm_serializer_registry():
+    serializer_class_registry.clear()
+    cycles = warm_serializer_registry([PetSerializer])
+
+    assert cycles == []
+    assert import_serializer_class('tests.testapp.PersonSerializer') is PersonSerializer
+    assert serializer_class_registry['tests.testapp.PersonSerializer'] is PersonSerializer
+
+
+def test_expansion_cycles_are_reported_by_system_checks(monkeypatch):
+    class OwnerSerializer(FlexFieldsModelSerializer):
+        class Meta:
+            model = Person
+            fields = ['name', 'pets']
+            expandable_fields = {'pets': ('tests.testapp.CyclicPetSerializer', {'many': True})}
+
+    class CyclicPetSerializer(FlexFieldsModelSerializer):
+        class Meta:
+            model = Pet
+            fields = ['name', 'owner']
+            expandable_fields = {'owner': (OwnerSerializer, {})}
+
+    serializer_class_registry['tests.testapp.CyclicPetSerializer'] = CyclicPetSerializer
+    monkeypatch.setattr(apps.get_app_config('rest_flex_fields'), 'expansion_cycles', warm_serializer_registry([OwnerSerializer]))
+    del serializer_class_registry['tests.testapp.CyclicPetSerializer']
+    warnings = [message for message in checks.run_checks() if message.id == 'rest_flex_fields.W001']
+
+    assert len(warnings) == 1
+    assert warnings[0].msg in (
+        'Serializers expand into each other in a cycle: OwnerSerializer -> CyclicPetSerializer -> OwnerSerializer.',
+        'Serializers expand into each other in a cycle: CyclicPetSerializer -> OwnerSerializer -> CyclicPetSerializer.',
+    )
+
+
+def test_related_fields_computed_once_per_class():
+    related_fields_cache.clear()
+    pet = Pet(name='Garfield', toys='paper ball, string', species='cat', owner=Person(name='Fred'))
+
+    assert PetSerializer(pet).related_fields == ['owner']
+    cached = related_fields_cache[PetSerializer]
+    assert PetSerializer(pet, fields=['name']).related_fields == []
+    assert PetSerializer(pet, expand=['owner']).related_fields == []
+    assert related_fields_cache[PetSerializer] is cached
+
+
+@pytest.mark.parametrize('identifier, owner', [
+    ('id', 7),
+    ('name', 'Fred'),
+])
+def test_identifier_fields_cloned_from_template(identifier, owner):
+    pet = Pet(name='Garfield', toys='paper ball, string', species='cat', owner=Person(id=7, name='Fred'))
+
+    first = PetSerializer(pet, identifier=identifier)
+    second = PetSerializer(pet, identifier=identifier)
+    assert first.fields['owner'] is not second.fields['owner']
+    assert first.fields['owner'].parent is first
+    assert first.data['owner'] == second.data['owner'] == owner
+
+
+def test_expandable_field_settings_are_read_only():
+    pet = Pet(name='Garfield', toys='paper ball, string', species='cat', owner=Person(name='Fred'))
+    serializer = PetSerializer(pet, expand=['owner'])
+    expandable_field = serializer._get_expandable_field('owner')
+
+    assert expandable_field.serializer_class is PersonSerializer
+    assert dict(expandable_field.settings) == {}
+    assert PetSerializer.Meta.expandable_fields['owner'] == (PersonSerializer, {'source': 'owner'})
+    with pytest.raises(TypeError):
+        expandable_field.settings['source'] = 'owner'
+
+
+def test_many_uses_flex_list_serializer():
+    owner = Person(name='Fred', hobbies='sailing', employer=Company(name='McDonalds'))
+    pets = [
+        Pet(name='Garfield', toys='paper ball, string', species='cat', owner=owner),
+        Pet(name='Odie', toys='bone', species='dog', owner=owner),
+    ]
+
+    serializer = PetSerializer(pets, many=True, expand=['owner'], omit=['toys'])
+    assert isinstance(serializer, FlexFieldsListSerializer)
+    assert serializer.data == [
+        {
+            'name': name,
+            'species': species,
+            'owner': {
+                'name': 'Fred',
+                'hobbies': 'sailing',
+                'employer': None
+            }
+        }
+        for name, species in (('Garfield', 'cat'), ('Odie', 'dog'))
+    ]
+
+
+def test_row_pipeline_matches_default_representation():
+    pet = Pet(name='Garfield', toys='paper ball, string', species='cat', owner=Person(id=3, name='Fred'))
+    serializer = PetSerializer(pet)
+
+    assert serializer.data == serializers.ModelSerializer.to_representation(serializer, pet)
+    assert PetSerializer({'name': 'Garfield', 'toys': 'string'}, fields=['name']).data == {'name': 'Garfield'}
+
+
+@pytest.mark.parametrize('copy_on_return', [True, False])
+def test_memoized_expanded_representations(copy_on_return, monkeypatch):
+    monkeypatch.setattr(PetSerializer, 'memoize_representations', True)
+    monkeypatch.setattr(PetSerializer, 'copy_memoized_representations', copy_on_return)
+    employer = Company(id=1, name='McDonalds')
+    pets = [
+        Pet(name='Garfield', species='cat', owner=Person(id=1, name='Fred', employer=employer)),
+        Pet(name='Odie', species='dog', owner=Person(id=1, name='Fred', employer=employer)),
+        Pet(name='Nermal', species='cat', owner=Person(id=2, name='Jon', employer=employer)),
+    ]
+
+    serializer = PetSerializer(pets, many=True, expand=['owner.employer'], fields=['name', 'owner'])
+    data = serializer.data
+    owners = [pet['owner'] for pet in data]
+
+    assert [owner['name'] for owner in owners] == ['Fred', 'Fred', 'Jon']
+    assert (owners[0] is owners[1]) is not copy_on_return
+    assert (owners[0]['employer'] is owners[2]['employer']) is not copy_on_return
+    assert owners[0] == owners[1]
+    assert len(serializer._representation_memo_store) == 3
+
+
+@pytest.mark.parametrize('serializer_class, limits, expand, error', [
+    (PetSerializer, {'max_expand_depth': 1}, ['owner.employer'],
+     'Expanding "owner.employer" exceeds the maximum depth of 1.'),
+    (PetSerializer, {'max_expand_nodes': 1}, ['*', 'owner.*'],
+     'Expanding "owner.employer" exceeds the maximum of 1 expanded fields.'),
+    (PersonWithPetsSerializer, {'max_expand_cost': 2, 'expand_many_cost': 5}, ['pets'],
+     'Expanding "pets" exceeds the maximum expansion cost of 2.'),
+])
+def test_expand_budget_rejects(serializer_class, limits, expand, error, monkeypatch):
+    for name, value in limits.items():
+        monkeypatch.setattr(serializer_class, name, value)
+
+    with pytest.raises(serializers.ValidationError) as e:
+        serializer_class(expand=expand)
+
+    assert e.value.detail == {'expand': [error]}
+
+
+def test_expand_budget_truncates_breadth_first(monkeypatch):
+    monkeypatch.setattr(PersonWithPetsSerializer, 'max_expand_cost', 3)
+    monkeypatch.setattr(PersonWithPetsSerializer, 'expand_many_cost', 2)
+    monkeypatch.setattr(PersonWithPetsSerializer, 'expand_overflow', 'truncate')
+    serializer = PersonWithPetsSerializer(expand=['pets.owner.employer', 'employer'])
+
+    assert isinstance(serializer.fields['employer'], serializers.Serializer)
+    assert isinstance(serializer.fields['pets'], serializers.ListSerializer)
+    assert not isinstance(serializer.fields['pets'].child.fields['owner'], serializers.Serializer)
+
+
+def test_sparse_fields_are_never_built(monkeypatch):
+    monkeypatch.setattr(PetSerializer, 'use_field_template', False)
+    built = []
+    build_field = serializers.ModelSerializer.build_field
+    monkeypatch.setattr(
+        serializers.ModelSerializer, 'build_field', lambda self, name, *args: built.append(name) or build_field(self, name, *args)
+    )
+    pet = Pet(name='Garfield', toys='paper ball, string', species='cat', owner=Person(id=3, name='Fred'))
+
+    assert PetSerializer(pet, fields=['name', 'species'], omit=['species']).data == {'name': 'Garfield'}
+    assert built == ['name']
+    assert PetSerializer(pet, omit=['toys', 'owner']).data == {'name': 'Garfield', 'species': 'cat'}
+
+
+def test_field_template_is_built_once_and_cloned(monkeypatch):
+    PetSerializer(expand=['owner'])
+    built = []
+    build_field = serializers.ModelSerializer.build_field
+    monkeypatch.setattr(
+        serializers.ModelSerializer, 'build_field', lambda self, name, *args: built.append(name) or build_field(self, name, *args)
+    )
+    first, second = PetSerializer(expand=['owner']), PetSerializer(omit=['toys'])
+
+    assert built == []
+    assert list(second.fields) == ['owner', 'name', 'species']
+    assert first.fields['name'] is not second.fields['name']
+    assert first.fields['name'].parent is first and second.fields['name'].parent is second
+
+
+CODE = re.compile(r'^[A-Z]+$')
+
+
+class CodeValidator:
+    def __call__(self, value):
+        pass
+
+
+class ContextCodeValidator(CodeValidator):
+    def set_context(self, field):
+        self.field = field
+
+
+validate_code = CodeValidator()
+
+
+def test_field_clones_share_no_state():
+    class OwnedPetSerializer(PetSerializer):
+        created_by = serializers.HiddenField(default=serializers.CurrentUserDefault())
+        code = serializers.RegexField(CODE, validators=[validate_code, ContextCodeValidator()], required=False)
+
+        class Meta(PetSerializer.Meta):
+            fields = PetSerializer.Meta.fields + ['created_by', 'code']
+
+    first, second = OwnedPetSerializer(), OwnedPetSerializer()
+    first.fields['name'].validators.append(lambda value: None)
+
+    assert first.fields['created_by'].default is not second.fields['created_by'].default
+    assert first.fields['code'].validators[0] is second.fields['code'].validators[0] is validate_code
+    assert first.fields['code'].validators[1] is not second.fields['code'].validators[1]
+    assert first.fields['code']._args[0] is second.fields['code']._args[0] is CODE
+    assert first.fields['name'].error_messages is not second.fields['name'].error_messages
+    assert len(first.fields['name'].validators) == len(OwnedPetSerializer().fields['name'].validators) + 1
+    assert not set(map(id, first.fields['name'].validators)) & set(map(id, second.fields['name'].validators))
+
+
+def test_hyperlinked_related_field_memoizes_url_template(monkeypatch):
+    request = Request(APIRequestFactory().get('/people/'))
+    reversed_urls = []
+    field = HyperlinkedRelatedField(view_name='pet-detail', many=True, read_only=True)
+    field.bind('pets', serializers.Serializer(context={'request': request}))
+    monkeypatch.setattr(
+        field.child_relation, 'reverse', lambda *args, **kwargs: reversed_urls.append(args) or reverse(*args, **kwargs)
+    )
+    pets = [Pet(id=pk) for pk in (1, 20, 300)]
+    expected = serializers.HyperlinkedRelatedField(view_name='pet-detail', many=True, read_only=True)
+    expected.bind('pets', serializers.Serializer(context={'request': request}))
+
+    assert field.to_representation(pets) == expected.to_representation(pets) == [
+        'http://testserver/pets/1/', 'http://testserver/pets/20/', 'http://testserver/pets/300/'
+    ]
+    assert len(reversed_urls) == 1
+    assert field.child_relation.get_url(-1, 'pet-detail', request, None) == 'http://testserver/pets/-1/'
+    assert len(reversed_urls) == 2
@@ -1,6 +1,22 @@
+import json
 import pytest
+from django.db import connection
+from django.db.models import Prefetch, Value
+from django.db.models.functions import Concat
+from django.db.models.signals import m2m_changed
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from rest_framework import serializers
+from rest_framework.permissions import BasePermission
+from rest_framework.request import Request
 from tests.testapp.models import Pet, Person, Company
+from rest_flex_fields import profiling
+from rest_flex_fields.pool import serializer_pool
+from rest_flex_fields.profiling import request_profiled
+from rest_flex_fields.representation_cache import representation_cache
+from rest_flex_fields.serializers import FlexFieldsSerializerMixin, HyperlinkedRelatedField
+from tests.testapp.serializers import PersonWithPetsSerializer, PetSerializer
+from tests.testapp.views import PersonViewSet, PetViewSet
 
 pytestmark = pytest.mark.django_db
 
@@ -152,3 +168,466 @@ def test_list_nested_expand(expand, client):
             }
         }
     }
+
+
+def test_list_sparse_prunes_columns(client):
+    url = reverse('pet-list') + '?fields=name'
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url, format='json')
+
+    assert response.data[0] == {'name': 'Garfield'}
+    assert len(queries) == 1
+    assert '"testapp_pet"."name"' in queries[0]['sql']
+    assert '"testapp_pet"."toys"' not in queries[0]['sql']
+
+
+@pytest.mark.parametrize('select_related', ['owner', 'owner__employer'])
+@pytest.mark.parametrize('query', ['?fields=name', '?identifier=name&fields=name', '?expand=owner&fields=owner.name'])
+def test_list_sparse_keeps_columns_of_joined_queryset(select_related, query, client, monkeypatch):
+    monkeypatch.setattr(PetViewSet, 'queryset', Pet.objects.select_related(select_related))
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(reverse('pet-list') + query, format='json')
+
+    assert response.status_code == 200
+    assert response.data[0] in ({'name': 'Garfield'}, {'owner': {'name': 'Fred'}})
+    assert len(queries) == 1
+    assert '"testapp_pet"."toys"' not in queries[0]['sql']
+
+
+def test_list_sparse_deep_expand_prunes_joined_columns(client):
+    url = reverse('pet-list') + '?fields=owner.employer.name&expand=owner.employer'
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url, format='json')
+
+    assert response.data[0] == {'owner': {'employer': {'name': 'McDonalds'}}}
+    assert len(queries) == 1
+    assert '"testapp_company"."name"' in queries[0]['sql']
+    assert '"testapp_company"."public"' not in queries[0]['sql']
+    assert '"testapp_person"."hobbies"' not in queries[0]['sql']
+
+
+def test_list_expand_many_uses_optimized_prefetch(client):
+    url = reverse('person-list') + '?expand=pets.owner.employer&fields=name,pets.name,pets.owner.employer.name'
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url, format='json')
+
+    assert response.data[0] == {
+        'name': 'Fred',
+        'pets': [
+            {
+                'name': 'Garfield',
+                'owner': {
+                    'employer': {
+                        'name': 'McDonalds'
+                    }
+                }
+            }
+        ]
+    }
+    assert len(queries) == 2
+    # each pet's owner is the prefetching person, so its employer is joined there
+    people_query, pets_query = queries[0]['sql'], queries[1]['sql']
+    assert 'INNER JOIN "testapp_company"' in people_query
+    assert '"testapp_company"."public"' not in people_query
+    assert '"testapp_pet"."toys"' not in pets_query
+
+
+@pytest.mark.parametrize('prefetch', ['pets', 'pets__owner', Prefetch('pets__owner')])
+def test_list_expand_many_keeps_queryset_prefetches(prefetch, client, monkeypatch):
+    monkeypatch.setattr(PersonViewSet, 'queryset', Person.objects.prefetch_related(prefetch))
+    response = client.get(reverse('person-list') + '?expand=pets', format='json')
+
+    assert response.status_code == 200
+    assert [pet['name'] for pet in response.data[0]['pets']] == ['Garfield']
+
+
+@pytest.mark.parametrize('url, query_count', [
+    (reverse('pet-list') + '?expand=*', 1),
+    (reverse('pet-list') + '?expand=owner,owner.employer,owner.*', 1),
+    (reverse('person-list') + '?expand=pets,employer', 2),
+    (reverse('person-list') + '?expand=pets.owner,pets.*', 2),
+], ids=('wildcard', 'duplicate-paths', 'prefetch', 'prefetch-wildcard'))
+def test_query_plan_counts(url, query_count, client):
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url, format='json')
+
+    assert response.status_code == 200
+    assert response.renderer_context['view'].get_query_plan().query_count == query_count
+    assert len(queries) == query_count
+
+
+@pytest.mark.parametrize('url', [
+    reverse('pet-list'),
+    reverse('pet-list') + '?expand=owner.employer',
+    reverse('pet-detail', args=[1]) + '?expand=owner',
+], ids=('list', 'list-expand', 'retrieve'))
+@pytest.mark.parametrize('shared', [False, True], ids=('default', 'shared'))
+def test_planning_serializer_is_shared_on_opt_in(shared, url, client, monkeypatch):
+    monkeypatch.setattr(PetSerializer, 'share_planning_serializer', shared)
+    builds = []
+    init = FlexFieldsSerializerMixin._init_flex_fields
+    monkeypatch.setattr(
+        FlexFieldsSerializerMixin, '_init_flex_fields',
+        lambda self, *args, **kwargs: builds.append(kwargs.get('parent')) or init(self, *args, **kwargs)
+    )
+    response = client.get(url, format='json')
+
+    assert response.status_code == 200
+    assert builds.count(None) == (1 if shared else 2)
+
+
+def test_response_serializer_is_built_with_its_instance(client, pet, monkeypatch):
+    class LabelledPetSerializer(PetSerializer):
+        def get_fields(self):
+            fields = super().get_fields()
+            if self.instance is not None:
+                fields['label'] = serializers.ReadOnlyField(source='name')
+            return fields
+
+    monkeypatch.setattr(PetViewSet, 'serializer_class', LabelledPetSerializer)
+    response = client.get(reverse('pet-detail', args=[pet.id]) + '?fields=name,label', format='json')
+
+    assert response.data == {'name': 'Garfield', 'label': 'Garfield'}
+
+
+def test_get_query_plan(rf):
+    request = Request(rf.get(reverse('person-list') + '?expand=pets.owner.employer&fields=name,pets.name'))
+    view = PersonViewSet(request=request, format_kwarg=None)
+
+    assert view.get_query_plan().as_dict() == {
+        'model': 'testapp.Person',
+        'select_related': [],
+        'prefetch_related': [],
+        'prefetches': {
+            'pets': {
+                'model': 'testapp.Pet',
+                'select_related': [],
+                'prefetch_related': [],
+                'prefetches': {},
+                'only': ['id', 'name', 'owner']
+            }
+        },
+        'only': ['id', 'name']
+    }
+
+
+def test_expand_field_is_deprecated_but_planned(rf):
+    request = Request(rf.get(reverse('pet-list')))
+    view = PetViewSet(request=request, format_kwarg=None)
+
+    with pytest.warns(DeprecationWarning):
+        queryset = view.expand_field('owner.employer', Pet.objects.all())
+
+    assert queryset.query.select_related == {'owner': {'employer': {}}}
+
+
+def test_expand_field_overrides_are_still_called(client, pet, monkeypatch):
+    expanded = []
+    expand_field = PetViewSet.expand_field
+    monkeypatch.setattr(
+        PetViewSet, 'expand_field', lambda self, field, queryset, **kwargs: expanded.append(field) or expand_field(self, field, queryset, **kwargs)
+    )
+
+    with pytest.warns(DeprecationWarning), CaptureQueriesContext(connection) as queries:
+        response = client.get(reverse('pet-list') + '?expand=owner.employer', format='json')
+
+    assert response.data[0]['owner']['employer'] == {'name': 'McDonalds', 'public': False}
+    assert expanded == ['owner.employer']
+    assert len(queries) == 1
+
+
+@pytest.mark.parametrize('url', [
+    reverse('pet-list') + '?fields=name,owner',
+    reverse('pet-list') + '?expand=owner.employer',
+    reverse('pet-list') + '?expand=owner&fields=name,owner.name',
+    reverse('pet-detail', args=[1]) + '?expand=owner.employer&omit=toys',
+], ids=('sparse', 'deep-expand', 'sparse-expand', 'retrieve'))
+def test_values_projection_matches_default(url, client, monkeypatch):
+    expected = client.get(url, format='json').data
+    monkeypatch.setattr(PetViewSet, 'use_values_projection', True)
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url, format='json')
+
+    assert response.renderer_context['view'].get_values_projection() is not None
+    assert response.data == expected
+    assert len(queries) == 1
+
+
+def test_values_projection_falls_back(client, monkeypatch):
+    monkeypatch.setattr(PersonViewSet, 'use_values_projection', True)
+    response = client.get(reverse('person-list') + '?expand=pets', format='json')
+
+    assert response.renderer_context['view'].get_values_projection() is None
+    assert response.data[0]['pets'][0]['name'] == 'Garfield'
+
+
+@pytest.mark.parametrize('stream_format', ['json', 'ndjson'])
+def test_stream_list(stream_format, client, monkeypatch):
+    url = reverse('person-list') + '?expand=pets.owner.employer,employer'
+    expected = json.loads(json.dumps(client.get(url, format='json').data))
+    monkeypatch.setattr(PersonViewSet, 'stream_list', True)
+    monkeypatch.setattr(PersonViewSet, 'stream_format', stream_format)
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url, format='json')
+        content = b''.join(response.streaming_content).decode()
+
+    if stream_format == 'ndjson':
+        assert response['Content-Type'] == 'application/x-ndjson'
+        assert [json.loads(line) for line in content.splitlines()] == expected
+    else:
+        assert json.loads(content) == expected
+    assert len(queries) == 2
+
+
+def test_cached_representations_are_invalidated_through_expansions(client, pet, monkeypatch):
+    monkeypatch.setattr(PetSerializer, 'cache_representations', True)
+    representation_cache.clear()
+    url = reverse('pet-list') + '?expand=owner.employer'
+
+    assert client.get(url, format='json').data == client.get(url, format='json').data
+    assert representation_cache.info()[:3] == (1, 1, 0)
+
+    company = pet.owner.employer
+    company.name = 'Burger King'
+    company.save()
+    response = client.get(url, format='json')
+
+    assert response.data[0]['owner']['employer']['name'] == 'Burger King'
+    assert representation_cache.info()[:3] == (1, 2, 1)
+
+
+@pytest.mark.parametrize('pk_set', [None, {1}], ids=('clear', 'add'))
+def test_cached_representations_are_invalidated_by_m2m_changes(pk_set, client, pet, monkeypatch):
+    monkeypatch.setattr(PetSerializer, 'cache_representations', True)
+    representation_cache.clear()
+    url = reverse('pet-list') + '?expand=owner'
+    client.get(url, format='json')
+
+    # either side of a many-to-many relation to Person, such as company.clients.add(person)
+    m2m_changed.send(
+        sender=Company, instance=pet.owner.employer, action='post_add', reverse=False, model=Person, pk_set=pk_set
+    )
+    client.get(url, format='json')
+
+    # both sides are dependencies of the cached pets
+    assert representation_cache.info()[:3] == (0, 2, 2)
+
+
+def test_conditional_list_is_aware_of_expansions(client, pet, monkeypatch):
+    monkeypatch.setattr(PetViewSet, 'last_modified_field', 'updated_at')
+    url = reverse('pet-list') + '?expand=owner.employer'
+    response = client.get(url, format='json')
+    etag = response['ETag']
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+
+    assert response.status_code == 304
+    assert len(queries) == 1
+    assert client.get(reverse('pet-list') + '?expand=owner', format='json')['ETag'] != etag
+
+    pet.owner.employer.save()
+    response = client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+
+    assert response.status_code == 200
+    assert response['ETag'] != etag
+
+
+def test_conditional_retrieve_last_modified(client, pet, monkeypatch):
+    monkeypatch.setattr(PetViewSet, 'last_modified_field', 'updated_at')
+    url = reverse('pet-detail', args=[pet.id])
+    last_modified = client.get(url, format='json')['Last-Modified']
+
+    assert client.get(url, format='json', HTTP_IF_MODIFIED_SINCE=last_modified).status_code == 304
+    assert client.get(url + '?expand=owner', format='json', HTTP_IF_MODIFIED_SINCE=last_modified).status_code == 304
+
+
+def test_conditional_retrieve_of_missing_object(client, pet, monkeypatch):
+    monkeypatch.setattr(PetViewSet, 'last_modified_field', 'updated_at')
+
+    assert client.get(reverse('pet-detail', args=[pet.id]), format='json', HTTP_IF_NONE_MATCH='*').status_code == 304
+
+    response = client.get(reverse('pet-detail', args=[999]), format='json', HTTP_IF_NONE_MATCH='*')
+
+    assert response.status_code == 404
+    assert not response.has_header('ETag')
+
+
+@pytest.mark.parametrize('allowed, status_code', [(True, 304), (False, 403)])
+def test_conditional_retrieve_checks_object_permissions(allowed, status_code, client, pet, monkeypatch):
+    class OwnPets(BasePermission):
+        def has_object_permission(self, request, view, obj):
+            return allowed
+
+    monkeypatch.setattr(PetViewSet, 'last_modified_field', 'updated_at')
+    monkeypatch.setattr(PetViewSet, 'permission_classes', [OwnPets])
+    response = client.get(reverse('pet-detail', args=[pet.id]), format='json', HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+
+    assert response.status_code == status_code
+    assert response.has_header('ETag') is allowed
+
+
+@pytest.mark.parametrize('workers, extra_pets', [(None, 5), (2, 0)])
+def test_serialize_many_matches_many_true(workers, extra_pets):
+    # worker threads use their own connections, so they only see committed rows
+    Pet.objects.bulk_create(
+        Pet(name='pet %d' % i, toys='string', species='cat', owner=Person.objects.get()) for i in range(extra_pets)
+    )
+    queryset = Pet.objects.order_by('-name')
+    kwargs = {'expand': ['owner.employer'], 'omit': ['toys']}
+
+    assert PetSerializer.serialize_many(queryset, workers=workers, chunk_size=2, **kwargs) == \
+        PetSerializer(queryset, many=True, **kwargs).data
+
+
+def test_serialize_many_keeps_annotations_of_sliced_querysets(pet):
+    class LabelledPetSerializer(PetSerializer):
+        label = serializers.CharField(read_only=True)
+
+        class Meta(PetSerializer.Meta):
+            fields = PetSerializer.Meta.fields + ['label']
+
+    Pet.objects.bulk_create(Pet(name='pet %d' % i, toys='string', species='cat', owner=pet.owner) for i in range(3))
+    queryset = Pet.objects.annotate(label=Concat('species', Value(': '), 'name')).order_by('-name')[1:3]
+
+    assert LabelledPetSerializer.serialize_many(queryset, chunk_size=1) == \
+        LabelledPetSerializer(queryset, many=True).data == [
+            {'owner': pet.owner.pk, 'name': 'pet 1', 'toys': 'string', 'species': 'cat', 'label': 'cat: pet 1'},
+            {'owner': pet.owner.pk, 'name': 'pet 0', 'toys': 'string', 'species': 'cat', 'label': 'cat: pet 0'},
+        ]
+
+
+def test_expand_budget_is_checked_before_queries(client, monkeypatch):
+    monkeypatch.setattr(PetSerializer, 'max_expand_depth', 1)
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(reverse('pet-list') + '?expand=owner.employer', format='json')
+
+    assert response.status_code == 400
+    assert response.data == {'expand': ['Expanding "owner.employer" exceeds the maximum depth of 1.']}
+    assert len(queries) == 0
+
+
+@pytest.mark.parametrize('thread_local', [False, True], ids=('contextvars', 'threading-local'))
+def test_profiled_request(thread_local, client, pet, monkeypatch):
+    if thread_local:
+        monkeypatch.setattr(profiling, '_current_profile', profiling._LocalVar())
+    monkeypatch.setattr(PetViewSet, 'profile_requests', True)
+    monkeypatch.setattr(PetViewSet, 'profile_debug_key', '_profile')
+    profiles = []
+    receiver = lambda sender, profile, request, **kwargs: profiles.append(profile)
+    request_profiled.connect(receiver)
+
+    try:
+        response = client.get(reverse('pet-detail', args=[pet.id]) + '?expand=owner.employer&omit=toys', format='json')
+    finally:
+        request_profiled.disconnect(receiver)
+
+    profile = profiles[0].as_dict()
+    assert [part.split(';')[0] for part in response['Server-Timing'].split(', ')] == [
+        'flex-parse', 'flex-build', 'flex-plan', 'flex-sql', 'flex-represent'
+    ]
+    assert response.data['_profile'] == profile
+    assert profile['counters']['queries'] == 1
+    assert profile['counters']['fields_dropped'] >= 1
+    assert profile['select_related'] == ['owner', 'owner__employer']
+
+
+def test_serializer_pool_reuses_trees(client, pet, monkeypatch):
+    monkeypatch.setattr(PetViewSet, 'serializer_pool_size', 3)
+    monkeypatch.setattr(PetSerializer, 'poolable', True)
+    serializer_pool.clear()
+    url = reverse('pet-list') + '?expand=owner.employer&omit=toys'
+
+    first = client.get(url, format='json')
+    idle = serializer_pool.info().idle
+    second = client.get(url, format='json')
+
+    assert first.data == second.data
+    assert idle > 0
+    assert serializer_pool.info().hits == idle
+    assert serializer_pool.info().idle == idle
+
+
+def test_serializer_pool_requires_opt_in(client, pet, monkeypatch):
+    monkeypatch.setattr(PetViewSet, 'serializer_pool_size', 3)
+    serializer_pool.clear()
+    client.get(reverse('pet-list'), format='json')
+
+    assert serializer_pool.info().idle == 0
+
+
+def test_serializer_pool_discards_leaked_state():
+    serializer_pool.clear()
+    key = ('leaky',)
+    serializer = PetSerializer()
+    serializer_pool.release(key, serializer, 2)
+    serializer._data = {'name': 'Garfield'}
+
+    assert serializer_pool.acquire(key) is None
+    assert serializer_pool.info().leaks == 1
+
+
+@pytest.mark.parametrize('fields_attribute', ['fields', '_fields'])
+def test_serializer_pool_drops_field_request_state(fields_attribute, rf, pet):
+    class PersonWithLinksSerializer(PersonWithPetsSerializer):
+        pets = HyperlinkedRelatedField(view_name='pet-detail', many=True, read_only=True)
+
+    serializer_pool.clear()
+    key = ('links',)
+    serializer = PersonWithLinksSerializer(Person.objects.all(), many=True, context={'request': Request(rf.get('/'))})
+    serializer.data
+    field = serializer.child.fields['pets'].child_relation
+    # DRF < 3.10 keeps the built fields in _fields
+    serializer.child.__dict__[fields_attribute] = serializer.child.__dict__.pop('fields')
+
+    assert field.__dict__.get('_url_templates_request') is not None
+    serializer_pool.release(key, serializer, 2)
+
+    assert '_url_templates_request' not in field.__dict__
+    assert serializer_pool.acquire(key) is serializer
+
+
+def _plain_errors(data):
+    serializer = PetSerializer(data=data)
+    serializer.is_valid()
+    return serializer.errors
+
+
+def test_list_payload_resolves_related_keys_in_one_query(pet):
+    data = [{'name': 'pet %d' % i, 'toys': 'ball', 'species': 'cat', 'owner': pet.owner.pk} for i in range(5)]
+    data.append({'name': 'stray', 'toys': 'ball', 'species': 'cat', 'owner': 999})
+
+    with CaptureQueriesContext(connection) as queries:
+        serializer = PetSerializer(data=data, many=True)
+        assert not serializer.is_valid()
+
+    assert len(queries) == 1
+    assert serializer.errors[:-1] == [{}] * 5
+    assert serializer.errors[-1] == _plain_errors(data[-1]) == {
+        'owner': ['Invalid pk "999" - object does not exist.']
+    }
+    # the original queryset is restored once validation is done
+    assert serializer.child.fields['owner'].queryset.model is Person
+    assert serializer.child.fields['owner'].queryset.query.where.children == []
+
+
+def test_many_related_payload_resolves_keys_in_one_query(pet):
+    class OwnerSerializer(PersonWithPetsSerializer):
+        pets = serializers.PrimaryKeyRelatedField(many=True, queryset=Pet.objects.all())
+
+    data = {'name': 'Jon', 'hobbies': 'lasagna', 'employer': pet.owner.employer_id, 'pets': [pet.pk, pet.pk]}
+
+    with CaptureQueriesContext(connection) as queries:
+        serializer = OwnerSerializer(data=data)
+        assert serializer.is_valid(), serializer.errors
+
+    # one query for the employer, one for both pets
+    assert len(queries) == 2
+    assert serializer.validated_data['pets'] == [pet, pet]
@@ -5,16 +5,19 @@ from django.db import models
 class Company(models.Model):
     name = models.CharField(max_length=30)
     public = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
 
 class Person(models.Model):
     name = models.CharField(max_length=30)
     hobbies = models.CharField(max_length=30)
     employer = models.ForeignKey(Company, on_delete=models.CASCADE)
+    updated_at = models.DateTimeField(auto_now=True)
 
 
 class Pet(models.Model):
     name = models.CharField(max_length=30)
     toys = models.CharField(max_length=30)
     species = models.CharField(max_length=30)
-    owner = models.ForeignKey(Person, on_delete=models.CASCADE)
+    owner = models.ForeignKey(Person, on_delete=models.CASCADE, related_name='pets')
+    updated_at = models.DateTimeField(auto_now=True)
@@ -26,4 +26,16 @@ class PetSerializer(FlexFieldsModelSerializer):
         fields = ['owner', 'name', 'toys', 'species']
         expandable_fields = {
             'owner': (PersonSerializer, {'source': 'owner'})
-        }
\ No newline at end of file
+        }
+
+
+class PersonWithPetsSerializer(FlexFieldsModelSerializer):
+    pets = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+
+    class Meta:
+        model = Person
+        fields = ['name', 'hobbies', 'employer', 'pets']
+        expandable_fields = {
+            'employer': (CompanySerializer, {'source': 'employer'}),
+            'pets': (PetSerializer, {'source': 'pets', 'many': True})
+        }
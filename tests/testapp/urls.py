@@ -1,10 +1,11 @@
 from django.conf.urls import url, include
 from rest_framework import routers
-from tests.testapp.views import PetViewSet
+from tests.testapp.views import PetViewSet, PersonViewSet
 
 
 router = routers.DefaultRouter()
 router.register(r'pets', PetViewSet, base_name='pet')
+router.register(r'people', PersonViewSet, base_name='person')
 
 urlpatterns = [
     url(r'^', include(router.urls))
@@ -1,8 +1,13 @@
 from rest_flex_fields import FlexFieldsModelViewSet
-from tests.testapp.serializers import PetSerializer
-from tests.testapp.models import Pet
+from tests.testapp.serializers import PetSerializer, PersonWithPetsSerializer
+from tests.testapp.models import Pet, Person
 
 
 class PetViewSet(FlexFieldsModelViewSet):
     serializer_class = PetSerializer
     queryset = Pet.objects.all()
+
+
+class PersonViewSet(FlexFieldsModelViewSet):
+    serializer_class = PersonWithPetsSerializer
+    queryset = Person.objects.all()